@@ -6,14 +6,41 @@ import os
 from flask import Flask
 from .data_ingestor import DataIngestor
 from .task_runner import ThreadPool
+from .dataset_reloader import DatasetReloader
+from .webserver_log import logger
 
 if not os.path.exists('results'):
     os.mkdir('results')
 
 webserver = Flask(__name__)
 
-webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+CSV_PATH = os.getenv("DATA_CSV_PATH", "./nutrition_activity_obesity_usa_subset.csv")
+
+
+def load_data_ingestor(csv_path, previous = None):
+
+    """
+        It loads the dataset with the options from the environment, reusing
+        the unchanged questions of the previous version on a reload.
+    """
+
+    data_ingestor = DataIngestor(csv_path,
+                                 compact = os.getenv("DATA_COMPACT") == "1",
+                                 value_dtype = os.getenv("DATA_VALUE_DTYPE", "float64"),
+                                 snapshot_dir = os.getenv("DATA_SNAPSHOT_DIR", "snapshot") or None,
+                                 previous = previous,
+                                 chunksize = int(os.getenv("DATA_CHUNKSIZE", "0")) or None)
+    logger.info("Question index built: %s", data_ingestor.get_index_report())
+
+    return data_ingestor
+
+
+webserver.data_ingestor = load_data_ingestor(CSV_PATH)
 webserver.tasks_runner = ThreadPool(webserver.data_ingestor) 
-webserver.job_counter = 1
+
+#  the current dataset is the one of the tasks runner, which can be reloaded
+webserver.dataset_reloader = DatasetReloader(webserver.tasks_runner, load_data_ingestor, CSV_PATH)
+if os.getenv("DATA_WATCH_SECONDS"):
+    webserver.dataset_reloader.watch(float(os.getenv("DATA_WATCH_SECONDS")))
 
 from app import routes
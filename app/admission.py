@@ -0,0 +1,103 @@
+"""
+    This module decides whether a new job is accepted, so that a burst of requests
+    gets fast rejections instead of growing the queue until the server runs out of memory.
+"""
+
+from collections import OrderedDict
+import math
+import threading
+import time
+
+
+class AdmissionControl:
+
+    """
+        It limits the number of waiting tasks to 'max_queue_depth' (0 for no limit)
+        and the submissions of every client to 'client_rate' per second (0 for no limit),
+        with bursts of at most 'client_burst' submissions (a token bucket per client).
+        At most 'max_clients' buckets are kept, the least recently used being dropped.
+    """
+
+    def __init__(self, max_queue_depth, client_rate, client_burst, max_clients = 10000):
+
+        """
+            It initializes the limits, the buckets and the counters of the rejections.
+        """
+
+        self.max_queue_depth = max_queue_depth
+        self.client_rate = client_rate
+        self.client_burst = max(client_burst, 1)
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"rate_limited": 0, "queue_full": 0}
+
+
+    def check_rate(self, client):
+
+        """
+            It takes a token from the bucket of the client and returns None, or it
+            returns the number of seconds until the next token if the bucket is empty.
+        """
+
+        if self.client_rate <= 0:
+            return None
+
+        now = time.monotonic()
+
+        with self.lock:
+            tokens, last_time = self.buckets.pop(client, (self.client_burst, now))
+            tokens = min(self.client_burst, tokens + (now - last_time) * self.client_rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                retry_after = None
+            else:
+                retry_after = (1 - tokens) / self.client_rate
+                self.counters["rate_limited"] += 1
+
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last = False)
+
+        return retry_after
+
+
+    def check_depth(self, queue_depth, drain_seconds):
+
+        """
+            It returns None if one more task fits in the queue, otherwise the number
+            of seconds the waiting tasks need to be drained ('drain_seconds').
+        """
+
+        if self.max_queue_depth <= 0 or queue_depth < self.max_queue_depth:
+            return None
+
+        with self.lock:
+            self.counters["queue_full"] += 1
+
+        return drain_seconds
+
+
+    def get_stats(self):
+
+        """
+            It returns the limits and the number of rejected submissions.
+        """
+
+        with self.lock:
+            return {
+                **self.counters,
+                "max_queue_depth": self.max_queue_depth,
+                "client_rate": self.client_rate,
+                "client_burst": self.client_burst,
+            }
+
+
+def retry_after_header(seconds):
+
+    """
+        It returns the value of a Retry-After header: a whole number of seconds, at least 1.
+    """
+
+    return str(max(1, math.ceil(seconds)))
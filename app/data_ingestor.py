@@ -2,27 +2,121 @@
     This module handles data ingestion and analysis for health statistics.
 """
 
+import io
+import threading
+import time
 import pandas as pd
+from pandas.api.types import union_categoricals
+from .question_index import (EMPTY_STATS, add_question_fingerprints, aggregate_levels,
+                             build_question_index, merge_question_stats, question_fingerprints,
+                             split_question_index)
+from .snapshot import fingerprint, snapshot_directory, read_snapshot, write_snapshot
 
-class DataIngestor:
+def tuple_keys(index):
+
+    """
+        It builds the "('level1', 'level2', ...)" string keys of the results
+        for a whole MultiIndex at once, column by column.
+    """
+
+    if len(index) == 0:
+        return []
+
+    keys = "('" + index.get_level_values(0).astype(str)
+    for level in range(1, index.nlevels):
+        keys = keys + "', '" + index.get_level_values(level).astype(str)
+
+    return (keys + "')").tolist()
+
+
+def concat_rows(df, rows):
+
+    """
+        It returns the DataFrame with the rows added at its end, keeping the dtypes
+        of its columns (the categorical columns get the union of the categories).
+    """
+
+    columns = {}
+
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            columns[column] = union_categoricals([df[column], rows[column].astype('category')])
+        else:
+            columns[column] = pd.concat([df[column], rows[column].astype(df[column].dtype)],
+                                        ignore_index = True)
+
+    return pd.DataFrame(columns)
+
+
+class DataIngestor:   # pylint: disable=too-many-instance-attributes
 
     """
         It loads the data from the csv file.
         It computes different results regarding nutrition, activity, and obesity rate.
     """
 
-    def __init__(self, csv_path: str):
+    # pylint: disable=too-many-arguments
+    def __init__(self, csv_path: str, *, compact: bool = False, value_dtype: str = 'float64',
+                 snapshot_dir: str = None, previous: 'DataIngestor' = None,
+                 chunksize: int = None):
 
         """
             It reads the data from the csv file, using only the necessary columns.
-            It stores the result in a two-dimensional data structure from pandas DataFrame.
+            It stores the result in a two-dimensional data structure from pandas DataFrame
+            and builds the per-question index that answers all queries.
+
+            In compact mode, the string columns are stored as categorical columns
+            (integer codes and one dictionary per column), so equality filters
+            compare integers, and Data_Value is stored with the given dtype
+            (float32 or float64).
+
+            If a snapshot directory is given, the columns are memory-mapped from the
+            snapshot of the csv file when it exists and the csv is unchanged; otherwise
+            the csv is parsed and the snapshot is written for the next start.
+
+            If the previous version of the dataset is given (on a reload), the statistics
+            of the questions whose rows did not change are reused, and only the other
+            questions are aggregated again.
+
+            In streaming mode (a chunksize is given), the csv is read in chunks and
+            only the aggregates are kept: there is no DataFrame (df is None), no
+            snapshot and the dataset is aggregated entirely, even on a reload.
         """
 
         self.csv_path = csv_path
         self.useful_columns = ['LocationDesc', 'Question', 'Data_Value',
                                'Stratification1', 'StratificationCategory1']
-        with open(self.csv_path, 'r', encoding = 'utf-8') as csv_file:
-            self.df = pd.read_csv(csv_file, usecols = self.useful_columns)
+
+        column_types = None
+        if compact:
+            column_types = {column: 'category' for column in self.useful_columns}
+            column_types['Data_Value'] = value_dtype
+
+        self.value_dtype = value_dtype if compact else 'float64'
+        self.df = None
+        self.question_fingerprints = None
+        self.append_lock = threading.Lock()
+
+        #  where the data was loaded from and how long loading it took
+        self.load_report = {"loaded_from": 'csv', "load_seconds": 0.0,
+                            "reused_questions": 0, "build_seconds": 0.0}
+
+        load_start = time.perf_counter()
+
+        if chunksize is not None:
+            #  only the aggregates are kept, the index is built while reading
+            self.question_index = self.aggregate_chunks(chunksize)
+            self.load_report["loaded_from"] = 'csv chunks'
+            self.load_report["load_seconds"] = time.perf_counter() - load_start
+        else:
+            self.load_dataframe(column_types, snapshot_dir,
+                                f"compact-{value_dtype}" if compact else "default")
+            self.load_report["load_seconds"] = time.perf_counter() - load_start
+
+            #  aggregate every question once, so that queries are lookups instead of scans
+            index_start = time.perf_counter()
+            self.question_index = self.build_index(previous)
+            self.load_report["build_seconds"] = time.perf_counter() - index_start
 
         self.questions_best_is_min = [
             'Percent of adults aged 18 years and older who have an overweight classification',
@@ -50,6 +144,186 @@ class DataIngestor:
              'on 2 or more days a week'),
         ]
 
+    def load_dataframe(self, column_types, snapshot_dir, mode):
+
+        """
+            It loads the useful columns in a DataFrame, from the snapshot if there is
+            an up-to-date one, otherwise from the csv file, writing the snapshot then.
+        """
+
+        if snapshot_dir is not None:
+            snapshot_path = snapshot_directory(snapshot_dir, self.csv_path, mode)
+            csv_fingerprint = fingerprint(self.csv_path)
+            self.df = read_snapshot(snapshot_path, csv_fingerprint)
+
+            if self.df is not None:
+                self.load_report["loaded_from"] = 'snapshot'
+                return
+
+        with open(self.csv_path, 'r', encoding = 'utf-8') as csv_file:
+            self.df = pd.read_csv(csv_file, usecols = self.useful_columns, dtype = column_types)
+
+        if snapshot_dir is not None:
+            try:
+                write_snapshot(snapshot_path, self.df, csv_fingerprint)
+            except OSError:
+                #  the snapshot only speeds up the next start
+                pass
+
+
+    def build_index(self, previous):
+
+        """
+            It aggregates the rows of every question, reusing the statistics of the
+            previous version of the dataset for the questions whose rows did not change.
+        """
+
+        if previous is None:
+            return build_question_index(self.df)
+
+        changed = self.changed_questions(previous)
+        question_index = build_question_index(self.df[self.df['Question'].isin(changed)])
+
+        for question in self.get_question_fingerprints():
+            if question not in changed:
+                question_index[question] = previous.question_index[question]
+                self.load_report["reused_questions"] += 1
+
+        return question_index
+
+
+    def aggregate_chunks(self, chunksize):
+
+        """
+            It reads the csv file 'chunksize' rows at a time and adds the sums and
+            the counts of every chunk to the running aggregate tables, together with
+            the fingerprints of the rows, splitting the tables by question at the end.
+            No row is kept, so the memory used depends on the chunk size and on
+            the number of groups, not on the file size.
+        """
+
+        levels = None
+        self.question_fingerprints = {}
+
+        #  the string columns of every chunk are categorical, so they are grouped by codes
+        column_types = {column: 'category' for column in self.useful_columns
+                        if column != 'Data_Value'} | {'Data_Value': self.value_dtype}
+
+        with open(self.csv_path, 'r', encoding = 'utf-8') as csv_file:
+            for chunk in pd.read_csv(csv_file, usecols = self.useful_columns,
+                                     dtype = column_types, chunksize = chunksize):
+                chunk_levels = aggregate_levels(chunk)
+
+                if levels is None:
+                    levels = chunk_levels
+                else:
+                    levels = [level.add(chunk_level, fill_value = 0)
+                              for level, chunk_level in zip(levels, chunk_levels)]
+
+                add_question_fingerprints(self.question_fingerprints, chunk)
+
+        if levels is None:
+            return {}
+
+        return split_question_index(*(level.sort_index() for level in levels))
+
+
+    def get_question_stats(self, question):
+
+        """
+            It returns the precomputed statistics of a question, or empty statistics
+            if the question does not appear in the dataset.
+        """
+
+        return self.question_index.get(question, EMPTY_STATS)
+
+
+    def get_question_fingerprints(self):
+
+        """
+            It returns the fingerprint of the rows of every question,
+            computing them on the first call only.
+        """
+
+        if self.question_fingerprints is None:
+            self.question_fingerprints = question_fingerprints(self.df)
+
+        return self.question_fingerprints
+
+
+    def changed_questions(self, previous):
+
+        """
+            It returns the set of questions whose rows differ from the ones in the
+            previous version of the dataset, including the added and the removed ones.
+        """
+
+        fingerprints = self.get_question_fingerprints()
+        previous_fingerprints = previous.get_question_fingerprints()
+
+        return {question for question in fingerprints.keys() | previous_fingerprints.keys()
+                if fingerprints.get(question) != previous_fingerprints.get(question)}
+
+
+    def append_rows(self, rows):
+
+        """
+            It adds a batch of rows to the dataset: a DataFrame, a list of dicts (JSON)
+            or the text of a csv chunk (with a header), having at least the useful columns.
+            Only the new rows are aggregated, then their sums and counts are added to the
+            statistics of their questions, which are replaced one by one, so that a query
+            sees either the old or the new statistics of a question.
+            The DataFrame (if it is kept) is copied entirely with the new rows at its end,
+            so every batch costs O(rows of the dataset): the rows should be appended in
+            large batches rather than a few at a time.
+            It returns the set of questions which received rows.
+        """
+
+        if isinstance(rows, str):
+            rows = pd.read_csv(io.StringIO(rows))
+        elif not isinstance(rows, pd.DataFrame):
+            rows = pd.DataFrame(rows)
+
+        missing_columns = [column for column in self.useful_columns if column not in rows]
+        if missing_columns:
+            raise ValueError(f"Missing columns: {missing_columns}")
+
+        rows = rows[self.useful_columns].reset_index(drop = True)
+        rows['Data_Value'] = pd.to_numeric(rows['Data_Value'],
+                                           errors = 'coerce').astype(self.value_dtype)
+
+        added_index = build_question_index(rows)
+
+        with self.append_lock:
+            for question, added_stats in added_index.items():
+                self.question_index[question] = merge_question_stats(
+                    self.get_question_stats(question), added_stats)
+
+            if self.question_fingerprints is not None:
+                add_question_fingerprints(self.question_fingerprints, rows)
+
+            if self.df is not None:
+                self.df = concat_rows(self.df, rows)
+
+        return set(added_index)
+
+
+    def get_index_report(self):
+
+        """
+            It reports where the data was loaded from, how long loading it and building
+            the question index took and how much memory the index uses.
+        """
+
+        return {
+            **self.load_report,
+            "questions": len(self.question_index),
+            "index_bytes": sum(stats.memory_usage() for stats in self.question_index.values()),
+            "dataframe_bytes": 0 if self.df is None else
+                               int(self.df.memory_usage(deep = True).sum()),
+        }
+
+
     def get_states_mean(self, question):
 
         """
@@ -57,13 +331,7 @@ class DataIngestor:
             then sorts the results in ascending order.
         """
 
-        question_matches = self.df['Question'] == question
-        question_data = self.df[question_matches]
-
-        grouped_by_state = question_data.groupby('LocationDesc')
-        sorted_state_means = grouped_by_state['Data_Value'].mean().sort_values(ascending = True)
-
-        return sorted_state_means.to_dict()
+        return self.get_question_stats(question).summary().sorted_state_means()
 
 
     def get_state_mean(self, state, question):
@@ -73,15 +341,9 @@ class DataIngestor:
             average recorded value for that state.
         """
 
-        question_matches = self.df['Question'] == question
-        question_data = self.df[question_matches]
-
-        state_matches = question_data['LocationDesc'] == state
-        filtered_data = question_data[state_matches]
+        state_mean = self.get_question_stats(question).summary().state_mean(state)
 
-        state_mean = filtered_data['Data_Value'].mean()
-
-        return {state: float(state_mean)}
+        return {state: state_mean}
 
 
     def get_best5(self, question):
@@ -91,18 +353,9 @@ class DataIngestor:
             states, then returns the top 5 states based on those averages.
         """
 
-        sorted_state_means = self.get_states_mean(question)
-
-        values = list(sorted_state_means.items())
-
-        best5 = {}
+        summary = self.get_question_stats(question).summary()
 
-        if question in self.questions_best_is_min:
-            best5 = dict(values[:5])
-        else:
-            best5 = dict(values[::-1][:5])   #  reverse and take the first elements
-
-        return best5
+        return summary.select(5, largest = question not in self.questions_best_is_min)
 
 
     def get_worst5(self, question):
@@ -112,18 +365,9 @@ class DataIngestor:
             states, then returns the bottom 5 states based on those averages.
         """
 
-        sorted_state_means = self.get_states_mean(question)
-
-        values = list(sorted_state_means.items())
-
-        worst5 = {}
+        summary = self.get_question_stats(question).summary()
 
-        if question in self.questions_best_is_min:
-            worst5 = dict(values[::-1][:5])
-        else:
-            worst5 = dict(values[:5])
-
-        return worst5
+        return summary.select(5, largest = question in self.questions_best_is_min)
 
 
     def get_global_mean(self, question):
@@ -133,10 +377,7 @@ class DataIngestor:
             from the entire dataset.
         """
 
-        question_matches = self.df['Question'] == question
-        question_data = self.df[question_matches]
-
-        global_mean = question_data['Data_Value'].mean()
+        global_mean = self.get_question_stats(question).summary().global_mean
 
         return {"global_mean": float(global_mean)}
 
@@ -148,15 +389,7 @@ class DataIngestor:
             average and each state's average for all states in the dataset.
         """
 
-        global_mean = self.get_global_mean(question)
-        sorted_state_means = self.get_states_mean(question)
-
-        diff_from_mean = {}
-
-        for state, mean in sorted_state_means.items():
-            diff_from_mean[state] = global_mean["global_mean"] - mean
-
-        return diff_from_mean
+        return self.get_question_stats(question).summary().diffs_from_mean()
 
 
     def get_state_diff_from_mean(self, state, question):
@@ -166,10 +399,9 @@ class DataIngestor:
             between the global average and that particular state's average.
         """
 
-        global_mean = self.get_global_mean(question)
-        state_mean = self.get_state_mean(state, question)
+        summary = self.get_question_stats(question).summary()
 
-        return {state: float(global_mean["global_mean"] - state_mean[state])}
+        return {state: float(summary.global_mean - summary.state_mean(state))}
 
 
     def get_mean_by_category(self, question):
@@ -179,19 +411,9 @@ class DataIngestor:
             (Stratification1) within each category (StratificationCategory1) for every state.
         """
 
-        question_matches = self.df['Question'] == question
-        question_data = self.df[question_matches]
-
-        result = {}
-
-        grouped = question_data.groupby(['LocationDesc', 'StratificationCategory1',
-                                         'Stratification1'])
+        segment_means = self.get_question_stats(question).segment_means()
 
-        for (state, category, segment), group_data in grouped:
-            key = f"('{state}', '{category}', '{segment}')"
-            result[key] = group_data['Data_Value'].mean()
-
-        return result
+        return dict(zip(tuple_keys(segment_means.index), segment_means.tolist()))
 
 
     def get_state_mean_by_category(self, state, question):
@@ -202,19 +424,17 @@ class DataIngestor:
             (StratificationCategory1) for that particular state.
         """
 
-        question_matches = self.df['Question'] == question
-        question_data = self.df[question_matches]
+        segment_means = self.get_question_stats(question).state_segment_means(state)
 
-        state_matches = question_data['LocationDesc'] == state
-        filtered_data = question_data[state_matches]
+        return {state: dict(zip(tuple_keys(segment_means.index), segment_means.tolist()))}
 
-        result = {state: {}}
 
-        grouped_by_category_segment = filtered_data.groupby(['StratificationCategory1',
-                                                             'Stratification1'])
+    def get_batch(self, queries):
 
-        for (category, segment), group_data in grouped_by_category_segment:
-            key = f"('{category}', '{segment}')"
-            result[state][key] = group_data['Data_Value'].mean()
+        """
+            It answers a list of (task_type, args) queries, returning the results in order.
+            The per-state summary of a question is computed once, then shared by all
+            the queries on that question.
+        """
 
-        return result
+        return [getattr(self, task_type)(*args) for task_type, args in queries]
@@ -0,0 +1,108 @@
+"""
+    This module reloads the dataset while the webserver is running.
+"""
+
+import os
+import threading
+import time
+
+
+class DatasetReloader:
+
+    """
+        It loads a new version of the csv file into a fresh data ingestor, in a
+        background thread, and then sets it on the threadpool at once.
+        The jobs submitted before the swap finish on the dataset they were submitted on.
+        Only one reload runs at a time.
+    """
+
+    def __init__(self, threadpool, load_data_ingestor, csv_path):
+
+        """
+            It initializes the reloader of the csv file at 'csv_path'.
+            'load_data_ingestor(csv_path, previous)' creates the new data ingestor,
+            reusing what it can from the previous one.
+        """
+
+        self.threadpool = threadpool
+        self.load_data_ingestor = load_data_ingestor
+        self.csv_path = csv_path
+        self.lock = threading.Lock()
+        self.reload_thread = None
+        self.csv_mtime = self.get_csv_mtime()
+        self.status = {"state": "idle", "version": 1, "error": None}
+
+
+    def get_csv_mtime(self):
+
+        """
+            It returns the modification time of the csv file, or None if it is missing.
+        """
+
+        try:
+            return os.stat(self.csv_path).st_mtime_ns
+        except OSError:
+            return None
+
+
+    def reload(self):
+
+        """
+            It starts reloading the dataset.
+            It returns False if a reload is already in progress.
+        """
+
+        with self.lock:
+            if self.reload_thread is not None and self.reload_thread.is_alive():
+                return False
+
+            self.status = {**self.status, "state": "loading", "error": None}
+            self.reload_thread = threading.Thread(target = self.load, daemon = True)
+            self.reload_thread.start()
+
+            return True
+
+
+    def load(self):
+
+        """
+            It builds the new data ingestor and swaps it in, dropping only the
+            cached results of the questions whose rows changed.
+        """
+
+        start = time.perf_counter()
+        previous = self.threadpool.data_ingestor
+
+        try:
+            self.csv_mtime = self.get_csv_mtime()
+            data_ingestor = self.load_data_ingestor(self.csv_path, previous)
+            changed_questions = data_ingestor.changed_questions(previous)
+            self.threadpool.set_data_ingestor(data_ingestor, changed_questions)
+        except (OSError, ValueError, KeyError) as error:
+            self.status = {**self.status, "state": "failed", "error": str(error)}
+            return
+
+        self.status = {
+            "state": "idle",
+            "version": self.status["version"] + 1,
+            "error": None,
+            "changed_questions": len(changed_questions),
+            "reused_questions": data_ingestor.load_report["reused_questions"],
+            "seconds": time.perf_counter() - start,
+        }
+
+
+    def watch(self, interval):
+
+        """
+            It starts a daemon thread which reloads the dataset every time
+            the csv file is modified, checking every 'interval' seconds.
+        """
+
+        def check_csv():
+            while True:
+                time.sleep(interval)
+                if self.get_csv_mtime() not in (None, self.csv_mtime):
+                    self.reload()
+
+        threading.Thread(target = check_csv, daemon = True).start()
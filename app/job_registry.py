@@ -0,0 +1,184 @@
+"""
+    This module allocates the job ids and keeps the status of the jobs.
+"""
+
+from array import array
+import threading
+
+STATUSES = ["pending", "processing", "completed", "failed"]
+
+#  the statuses of the jobs which will not change anymore
+FINISHED_STATUSES = ["completed", "failed"]
+
+
+class JobRegistry:   # pylint: disable=too-many-instance-attributes
+
+    """
+        It allocates consecutive job ids, starting from 1, and keeps the status
+        of every job in compact arrays: one byte for the status, one byte for
+        the task type and two bytes for the worker, so about 4 bytes per job.
+        It also counts the jobs in every status and notifies the threads
+        waiting for jobs to finish (to be completed or to fail).
+    """
+
+    def __init__(self):
+
+        """
+            It initializes an empty registry.
+        """
+
+        self.lock = threading.Lock()
+        self.completion = threading.Condition(self.lock)
+        self.statuses = array('b')
+        self.task_types = array('b')
+        self.workers = array('h')
+        self.task_type_codes = {}
+        self.task_type_names = []
+        self.status_counts = [0] * len(STATUSES)
+
+
+    def allocate(self, task_type):
+
+        """
+            It registers a new pending job and returns its id.
+            The id is allocated under the lock, so concurrent requests
+            never get the same id.
+        """
+
+        with self.lock:
+            task_type_code = self.task_type_codes.get(task_type)
+            if task_type_code is None:
+                task_type_code = len(self.task_type_names)
+                self.task_type_codes[task_type] = task_type_code
+                self.task_type_names.append(task_type)
+
+            self.statuses.append(STATUSES.index("pending"))
+            self.task_types.append(task_type_code)
+            self.workers.append(-1)
+            self.status_counts[STATUSES.index("pending")] += 1
+
+            return len(self.statuses)
+
+
+    def set_status(self, job_id, status, worker):
+
+        """
+            It updates the status of a job and the worker handling it.
+        """
+
+        status_code = STATUSES.index(status)
+
+        with self.lock:
+            self.status_counts[self.statuses[job_id - 1]] -= 1
+            self.status_counts[status_code] += 1
+            self.statuses[job_id - 1] = status_code
+            self.workers[job_id - 1] = worker
+
+            if status in FINISHED_STATUSES:
+                self.completion.notify_all()
+
+
+    def get(self, job_id):
+
+        """
+            It returns the status of a job as a dict, or None for an unknown job_id.
+        """
+
+        with self.lock:
+            if job_id < 1 or job_id > len(self.statuses):
+                return None
+
+            status_code = self.statuses[job_id - 1]
+            task_type_code = self.task_types[job_id - 1]
+            worker = self.workers[job_id - 1]
+
+        return self.record(status_code, task_type_code, worker)
+
+
+    def record(self, status_code, task_type_code, worker):
+
+        """
+            It converts the codes stored for a job into its status dict.
+        """
+
+        return {
+            "status": STATUSES[status_code],
+            "task_type": self.task_type_names[task_type_code],
+            "worker": None if worker < 0 else worker,
+        }
+
+
+    def scan(self, after = 0, status = None, task_type = None, chunk_size = 1000):
+
+        """
+            It yields (job_id, status dict) for the jobs with an id greater than 'after',
+            optionally only those with the given status or task type.
+            The tables are copied 'chunk_size' jobs at a time, so the lock is held
+            only briefly and the memory used does not depend on the number of jobs.
+        """
+
+        status_code = None if status is None else STATUSES.index(status)
+        task_type_code = None
+
+        if task_type is not None:
+            task_type_code = self.task_type_codes.get(task_type)
+            if task_type_code is None:
+                return
+
+        chunk_start = max(after, 0)
+
+        while True:
+            with self.lock:
+                chunk_end = min(chunk_start + chunk_size, len(self.statuses))
+                statuses = self.statuses[chunk_start:chunk_end]
+                task_types = self.task_types[chunk_start:chunk_end]
+                workers = self.workers[chunk_start:chunk_end]
+
+            if not statuses:
+                return
+
+            for offset, job in enumerate(zip(statuses, task_types, workers)):
+                if status_code is not None and job[0] != status_code:
+                    continue
+                if task_type_code is not None and job[1] != task_type_code:
+                    continue
+
+                yield chunk_start + offset + 1, self.record(*job)
+
+            chunk_start = chunk_end
+
+
+    def wait_completed(self, job_ids, timeout):
+
+        """
+            It blocks until at least one of the (valid) job_ids is finished (completed
+            or failed) or until the timeout passes, and returns the finished ones.
+        """
+
+        finished_codes = [STATUSES.index(status) for status in FINISHED_STATUSES]
+
+        def completed_jobs():
+            return [job_id for job_id in job_ids
+                    if self.statuses[job_id - 1] in finished_codes]
+
+        with self.completion:
+            self.completion.wait_for(completed_jobs, timeout)
+            return completed_jobs()
+
+
+    def num_jobs(self):
+
+        """
+            It returns the number of allocated jobs, which is also the last job_id.
+        """
+
+        return len(self.statuses)
+
+
+    def count(self, status):
+
+        """
+            It returns the number of jobs in a status.
+        """
+
+        return self.status_counts[STATUSES.index(status)]
@@ -0,0 +1,330 @@
+"""
+    This module precomputes the JSON-encoded results of every possible query (every
+    task type, on every question and every state), so that a request is answered
+    by a dictionary lookup.
+
+    The table can be saved next to the snapshot of the csv file: the results of every
+    question are saved with the fingerprint of its rows, and the next start reuses
+    the results of the questions whose rows did not change.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from .data_ingestor import DataIngestor
+from .result_cache import MISSING
+from .snapshot import snapshot_directory
+from .webserver_log import logger
+
+MATERIALIZED_VERSION = 1
+
+QUESTION_TASKS = ["get_states_mean", "get_best5", "get_worst5", "get_global_mean",
+                  "get_diff_from_mean", "get_mean_by_category"]
+STATE_TASKS = ["get_state_mean", "get_state_diff_from_mean", "get_state_mean_by_category"]
+
+
+def question_queries(question, states):
+
+    """
+        It returns the (task_type, args) of all the queries on a question.
+    """
+
+    queries = [(task_type, (question,)) for task_type in QUESTION_TASKS]
+    queries += [(task_type, (state, question)) for state in states for task_type in STATE_TASKS]
+
+    return queries
+
+
+def dataset_states(data_ingestor):
+
+    """
+        It returns all the states of the dataset.
+    """
+
+    states = set()
+    for stats in data_ingestor.question_index.values():
+        states.update(stats.by_state.index)
+
+    return sorted(states)
+
+
+def read_saved(directory):
+
+    """
+        It returns the manifest and the results saved in a directory,
+        or None if there are none of this version.
+    """
+
+    try:
+        with open(os.path.join(directory, 'manifest.json'), 'r',
+                  encoding = 'utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+
+        if manifest.get("version") != MATERIALIZED_VERSION:
+            return None
+
+        with open(os.path.join(directory, 'results.bin'), 'rb') as results_file:
+            return manifest, results_file.read()
+    except (OSError, ValueError):
+        return None
+
+
+def write_saved(directory, table, fingerprints):
+
+    """
+        It writes the results of the table and their manifest to temporary files
+        with unique names in the directory, and returns their paths.
+    """
+
+    questions = {}
+    offset = 0
+
+    results_fd, results_path = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+    with os.fdopen(results_fd, 'wb') as results_file:
+        for (task_type, args), result in table.items():
+            entries = questions.setdefault(args[-1], {
+                "fingerprint": str(fingerprints.get(args[-1])), "entries": []})
+            entries["entries"].append([task_type, list(args), offset, len(result)])
+            results_file.write(result)
+            offset += len(result)
+
+    manifest_fd, manifest_path = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+    with os.fdopen(manifest_fd, 'w', encoding = 'utf-8') as manifest_file:
+        json.dump({"version": MATERIALIZED_VERSION, "questions": questions}, manifest_file)
+
+    return results_path, manifest_path
+
+
+class Materializer:   # pylint: disable=too-many-instance-attributes
+
+    """
+        It keeps the results of all the queries on one dataset, keyed like the
+        results cache by (task_type, args).
+        The generation is increased every time results are dropped, so that the
+        results computed before are not stored anymore.
+    """
+
+    def __init__(self, threadpool, num_workers, persist_dir = None):
+
+        """
+            It initializes an empty table. The results are computed through the
+            threadpool (in its worker processes with the process backend), by
+            'num_workers' questions at once, and saved in 'persist_dir' if it is given.
+        """
+
+        self.threadpool = threadpool
+        self.num_workers = max(num_workers, 1)
+        self.persist_dir = persist_dir
+        self.data_ingestor = None
+        self.table = {}
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.generation = 0
+        self.stats = {"state": "empty", "entries": 0, "result_bytes": 0, "table_bytes": 0,
+                      "loaded_entries": 0, "computed_entries": 0, "seconds": 0.0}
+
+
+    def get(self, key, data_ingestor):
+
+        """
+            It returns the precomputed result of a query on the given dataset,
+            or MISSING if there is none.
+        """
+
+        if data_ingestor is not self.data_ingestor:
+            return MISSING
+
+        return self.table.get(key, MISSING)
+
+
+    def invalidate(self, data_ingestor, changed_questions = None):
+
+        """
+            It makes the table the one of the given dataset, dropping the results of the
+            changed questions (or all of them if they are not known), and returns the
+            generation of the results which may be stored from now on.
+        """
+
+        with self.lock:
+            if changed_questions is None or self.data_ingestor is None:
+                self.table = {}
+            else:
+                self.table = {key: result for key, result in self.table.items()
+                              if key[1][-1] not in changed_questions}
+
+            self.data_ingestor = data_ingestor
+            self.generation += 1
+            self.stats = {**self.stats, "state": "building"}
+
+            return self.generation
+
+
+    def refresh(self, data_ingestor, changed_questions = None, generation = None):
+
+        """
+            It computes the results of the changed questions (all of them if they are not
+            known) on the given dataset, reading first the ones saved for the same rows,
+            then saves the table. The results are dropped if the table was invalidated
+            in the meantime.
+        """
+
+        if generation is None:
+            generation = self.invalidate(data_ingestor, changed_questions)
+
+        start = time.perf_counter()
+        states = dataset_states(data_ingestor)
+        questions = set(data_ingestor.question_index)
+        if changed_questions is not None:
+            questions &= set(changed_questions)
+
+        loaded = self.load(data_ingestor, questions)
+        loaded_questions = {key[1][-1] for key in loaded}
+
+        def compute_question(question):
+            if self.stopping.is_set():
+                return {}
+
+            queries = question_queries(question, states)
+            results = self.threadpool.compute("materialize", DataIngestor.get_batch,
+                                              [[(task_type, list(args))
+                                                for task_type, args in queries]],
+                                              data_ingestor)
+            return dict(zip(queries, results))
+
+        computed = {}
+        with ThreadPoolExecutor(max_workers = self.num_workers) as executor:
+            for results in executor.map(compute_question, sorted(questions - loaded_questions)):
+                computed.update(results)
+
+        with self.lock:
+            if generation != self.generation or self.stopping.is_set():
+                return
+
+            self.table.update(loaded)
+            self.table.update(computed)
+            self.stats = {
+                "state": "ready",
+                "entries": len(self.table),
+                "result_bytes": sum(len(result) for result in self.table.values()),
+                "table_bytes": sys.getsizeof(self.table) +
+                               sum(sys.getsizeof(key) + sys.getsizeof(result)
+                                   for key, result in self.table.items()),
+                "loaded_entries": len(loaded),
+                "computed_entries": len(computed),
+                "seconds": time.perf_counter() - start,
+            }
+
+        logger.info("Results materialized: %s", self.stats)
+
+        if computed:
+            self.save(data_ingestor, generation)
+
+
+    def directory(self, data_ingestor):
+
+        """
+            It returns the directory where the table of a dataset is saved, or None
+            if it is not saved (no persist_dir, or no rows to fingerprint in streaming mode).
+        """
+
+        if self.persist_dir is None or data_ingestor.df is None:
+            return None
+
+        return snapshot_directory(self.persist_dir, data_ingestor.csv_path, "materialized")
+
+
+    def load(self, data_ingestor, questions):
+
+        """
+            It returns the saved results of the given questions
+            whose rows are still the same.
+        """
+
+        directory = self.directory(data_ingestor)
+        if directory is None:
+            return {}
+
+        #  a save in progress would replace the results under the manifest being read
+        with self.save_lock:
+            saved = read_saved(directory)
+
+        if saved is None:
+            return {}
+
+        manifest, results = saved
+        fingerprints = data_ingestor.get_question_fingerprints()
+        loaded = {}
+
+        for question in questions:
+            entries = manifest["questions"].get(question)
+            if entries is None or entries["fingerprint"] != str(fingerprints.get(question)):
+                continue
+
+            for task_type, args, offset, length in entries["entries"]:
+                loaded[(task_type, tuple(args))] = results[offset:offset + length]
+
+        return loaded
+
+
+    def save(self, data_ingestor, generation):
+
+        """
+            It saves the table, the results first and then the manifest, which is
+            renamed into place last. Only one save runs at a time, and a table which
+            was invalidated while it was being written is not renamed into place.
+        """
+
+        directory = self.directory(data_ingestor)
+        if directory is None:
+            return
+
+        with self.lock:
+            if generation != self.generation:
+                return
+            table = dict(self.table)
+
+        with self.save_lock:
+            os.makedirs(directory, exist_ok = True)
+            temporary_paths = write_saved(directory, table,
+                                          data_ingestor.get_question_fingerprints())
+
+            with self.lock:
+                current = generation == self.generation
+
+            if not current:
+                for temporary_path in temporary_paths:
+                    os.remove(temporary_path)
+                return
+
+            results_path = os.path.join(directory, 'results.bin')
+            manifest_path = os.path.join(directory, 'manifest.json')
+
+            #  the old manifest is removed first, so that it never describes the new results
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            os.replace(temporary_paths[0], results_path)
+            os.replace(temporary_paths[1], manifest_path)
+
+
+    def stop(self):
+
+        """
+            It makes the refreshes in progress stop computing, without storing their results.
+        """
+
+        self.stopping.set()
+
+
+    def get_stats(self):
+
+        """
+            It returns the state of the table, its size and how long building it took.
+        """
+
+        with self.lock:
+            return dict(self.stats)
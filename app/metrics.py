@@ -0,0 +1,242 @@
+"""
+    This module keeps the runtime metrics of the task runners and exports them
+    in the Prometheus text format.
+
+    The durations are recorded in HDR-style histograms: every power of two is split
+    in SUB_BUCKETS linear buckets, so a duration is known within 1 / SUB_BUCKETS
+    of its value, with a fixed number of buckets from one microsecond to hours.
+    Recording a value is an index computation and an increment, cheap enough
+    to be done for every task.
+"""
+
+import threading
+import time
+
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+
+#  enough buckets for durations up to 2^40 microseconds (about 12 days)
+NUM_BUCKETS = (40 - SUB_BITS) * SUB_BUCKETS + 2 * SUB_BUCKETS
+
+#  the 'le' bounds (in seconds) of the exported buckets
+EXPORTED_BOUNDS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+def bucket_index(value):
+
+    """
+        It returns the bucket of a value (an integer number of microseconds).
+    """
+
+    shift = value.bit_length() - SUB_BITS - 1
+
+    if shift <= 0:
+        return value
+
+    index = shift * SUB_BUCKETS + (value >> shift)
+
+    return index if index < NUM_BUCKETS else NUM_BUCKETS - 1
+
+
+def bucket_upper_bound(index):
+
+    """
+        It returns the smallest value (in microseconds) which is above the bucket.
+    """
+
+    if index < 2 * SUB_BUCKETS:
+        return index + 1
+
+    shift = index // SUB_BUCKETS - 1
+
+    return (index - shift * SUB_BUCKETS + 1) << shift
+
+
+class Histogram:
+
+    """
+        It counts durations in log-linear buckets and keeps their sum.
+    """
+
+    def __init__(self):
+
+        """
+            It initializes an empty histogram.
+        """
+
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+
+    def record(self, seconds):
+
+        """
+            It adds a duration, in seconds.
+        """
+
+        index = bucket_index(int(seconds * 1e6)) if seconds > 0 else 0
+
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+
+
+    def percentile(self, percentile):
+
+        """
+            It returns the upper bound (in seconds) of the bucket holding the given
+            percentile, 0 if the histogram is empty.
+        """
+
+        with self.lock:
+            rank = self.count * percentile / 100
+            seen = 0
+
+            for index, bucket_count in enumerate(self.counts):
+                seen += bucket_count
+                if bucket_count and seen >= rank:
+                    return bucket_upper_bound(index) / 1e6
+
+        return 0.0
+
+
+    def export(self, name, labels):
+
+        """
+            It returns the lines of the histogram in the Prometheus text format,
+            with cumulative buckets at the EXPORTED_BOUNDS.
+        """
+
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            total = self.total
+
+        lines = []
+        cumulative = 0
+        index = 0
+
+        for bound in EXPORTED_BOUNDS:
+            while index < NUM_BUCKETS and bucket_upper_bound(index) <= bound * 1e6:
+                cumulative += counts[index]
+                index += 1
+
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f'{name}_sum{{{labels}}} {total}')
+        lines.append(f'{name}_count{{{labels}}} {count}')
+
+        return lines
+
+
+class Metrics:
+
+    """
+        It keeps a histogram per (stage, task type) and the busy time of every worker.
+        The stages are the queue wait, the computation, the serialization of the
+        result and the result write.
+    """
+
+    STAGES = {
+        "queue_wait": "Time spent by the tasks in the queue",
+        "compute": "Time spent computing the results",
+        "serialize": "Time spent encoding the results as JSON",
+        "result_write": "Time spent writing the results to the result store",
+    }
+
+    def __init__(self):
+
+        """
+            It initializes the metrics, starting the uptime.
+        """
+
+        self.start_time = time.monotonic()
+        self.histograms = {stage: {} for stage in self.STAGES}
+        self.submitted = {}
+        self.busy_seconds = {}
+        self.lock = threading.Lock()
+
+
+    def record(self, stage, task_type, seconds):
+
+        """
+            It adds the duration of a stage of a task.
+        """
+
+        histogram = self.histograms[stage].get(task_type)
+
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms[stage].setdefault(task_type, Histogram())
+
+        histogram.record(seconds)
+
+
+    def record_submit(self, task_type):
+
+        """
+            It counts a submitted job.
+        """
+
+        with self.lock:
+            self.submitted[task_type] = self.submitted.get(task_type, 0) + 1
+
+
+    def record_busy(self, worker, seconds):
+
+        """
+            It adds the time a worker spent handling a task.
+        """
+
+        with self.lock:
+            self.busy_seconds[worker] = self.busy_seconds.get(worker, 0.0) + seconds
+
+
+    def export(self, gauges = None):
+
+        """
+            It returns all the metrics in the Prometheus text format, followed
+            by the given gauges ({name: (help, {labels: value})}).
+        """
+
+        lines = []
+
+        for stage, description in self.STAGES.items():
+            name = f"tp_{stage}_seconds"
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+
+            for task_type, histogram in sorted(self.histograms[stage].items()):
+                lines += histogram.export(name, f'task_type="{task_type}"')
+
+        with self.lock:
+            submitted = dict(self.submitted)
+            busy_seconds = dict(self.busy_seconds)
+
+        uptime = time.monotonic() - self.start_time
+
+        lines += ["# HELP tp_jobs_submitted_total Jobs submitted",
+                  "# TYPE tp_jobs_submitted_total counter"]
+        lines += [f'tp_jobs_submitted_total{{task_type="{task_type}"}} {count}'
+                  for task_type, count in sorted(submitted.items())]
+
+        lines += ["# HELP tp_worker_busy_seconds_total Time spent by the workers on tasks",
+                  "# TYPE tp_worker_busy_seconds_total counter"]
+        lines += [f'tp_worker_busy_seconds_total{{worker="{worker}"}} {seconds}'
+                  for worker, seconds in sorted(busy_seconds.items())]
+
+        lines += ["# HELP tp_worker_utilization Busy time of the workers over the uptime",
+                  "# TYPE tp_worker_utilization gauge"]
+        lines += [f'tp_worker_utilization{{worker="{worker}"}} {seconds / uptime}'
+                  for worker, seconds in sorted(busy_seconds.items())]
+
+        for name, (description, values) in (gauges or {}).items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+            lines += [f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+                      for labels, value in values.items()]
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,127 @@
+"""
+    This module samples the stacks of the running threads, so that a slow period can
+    be profiled while the webserver is running, without restarting it.
+
+    The profile is returned as collapsed stacks ("root;caller;callee count" lines),
+    the input of flamegraph.pl, speedscope and similar tools.
+"""
+
+import os
+import sys
+import threading
+import time
+from .task_runner import TaskRunner
+
+#  longest profile (in seconds) and shortest interval (in seconds) between two samples
+PROFILE_MAX_SECONDS = 60.0
+PROFILE_MIN_INTERVAL = 0.001
+
+
+def thread_role(thread):
+
+    """
+        It returns the root frame of the stacks of a thread: 'task_runner' for the
+        task runners, 'request' for the threads of the development server which handle
+        the requests, otherwise the name of the thread.
+    """
+
+    if isinstance(thread, TaskRunner):
+        return "task_runner"
+
+    if "process_request_thread" in thread.name:
+        return "request"
+
+    return thread.name
+
+
+def frame_label(frame):
+
+    """
+        It returns the label of a frame: its function, file and line.
+    """
+
+    code = frame.f_code
+    path = os.path.join(os.path.basename(os.path.dirname(code.co_filename)),
+                        os.path.basename(code.co_filename))
+
+    return f"{code.co_name} ({path}:{frame.f_lineno})"
+
+
+class SamplingProfiler:   # pylint: disable=too-few-public-methods
+
+    """
+        It takes the stacks of the threads at regular intervals, from the thread
+        asking for the profile, and counts every distinct stack.
+        Only one profile is taken at a time: the lock is what the class is for,
+        next to its single method.
+    """
+
+    def __init__(self):
+
+        """
+            It initializes the profiler.
+        """
+
+        self.lock = threading.Lock()
+
+
+    def profile(self, seconds, interval, all_threads = False):
+
+        """
+            It samples the stacks of the task runners and of the request threads (or of
+            all the threads) every 'interval' seconds, during 'seconds' seconds.
+            It returns the counts of the collapsed stacks and the number of samples,
+            or None if a profile is already being taken.
+        """
+
+        #  a profile in progress is not waited for, so the lock is released in the finally
+        if not self.lock.acquire(blocking = False):   # pylint: disable=consider-using-with
+            return None
+
+        try:
+            seconds = min(seconds, PROFILE_MAX_SECONDS)
+            interval = max(interval, PROFILE_MIN_INTERVAL)
+            own_ident = threading.get_ident()
+            stacks = {}
+            samples = 0
+
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                threads = {thread.ident: thread for thread in threading.enumerate()}
+
+                for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                    thread = threads.get(ident)
+                    if ident == own_ident or thread is None:
+                        continue
+
+                    role = thread_role(thread)
+                    if not all_threads and role not in ("task_runner", "request"):
+                        continue
+
+                    labels = []
+                    while frame is not None:
+                        labels.append(frame_label(frame))
+                        frame = frame.f_back
+
+                    stack = ";".join([role] + labels[::-1])
+                    stacks[stack] = stacks.get(stack, 0) + 1
+
+                samples += 1
+                time.sleep(interval)
+
+            return stacks, samples
+        finally:
+            self.lock.release()
+
+
+def collapse(stacks):
+
+    """
+        It returns the collapsed stacks, the most frequent first.
+    """
+
+    return "".join(f"{stack} {count}\n"
+                   for stack, count in sorted(stacks.items(), key = lambda item: -item[1]))
+
+
+profiler = SamplingProfiler()
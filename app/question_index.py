@@ -0,0 +1,303 @@
+"""
+    This module precomputes per-question aggregates used by the data ingestor.
+"""
+
+import math
+import numpy as np
+import pandas as pd
+
+STATE_COLUMN = 'LocationDesc'
+SEGMENT_COLUMNS = ['LocationDesc', 'StratificationCategory1', 'Stratification1']
+AGGREGATES = ['sum', 'count']
+
+
+class QuestionSummary:
+
+    """
+        It holds the per-state statistics of a question as vectors: the states,
+        their number of values and their means, together with the global mean.
+        It is computed once per question and all the state-level queries derive from it.
+        The order of the states by mean is only computed by the queries which need it,
+        best5 and worst5 selecting their states without sorting them all.
+    """
+
+    def __init__(self, stats):
+
+        """
+            It computes the vectors from the aggregate tables of a question.
+        """
+
+        self.states = np.asarray(stats.by_state.index.astype(str), dtype = object)
+        self.state_counts = stats.by_state['count'].to_numpy(dtype = float)
+        self.state_means = stats.by_state['sum'].to_numpy(dtype = float) / self.state_counts
+        self.global_mean = stats.global_mean()
+        self.positions = {state: position for position, state in enumerate(self.states)}
+        self.cached_order = None
+
+
+    def sorted_order(self):
+
+        """
+            It returns the positions of the states in ascending order of their means,
+            computing them on the first call only.
+        """
+
+        if self.cached_order is None:
+            self.cached_order = np.argsort(self.state_means, kind = 'stable')
+
+        return self.cached_order
+
+
+    def sorted_state_means(self):
+
+        """
+            It returns the means of all states as a dict, in ascending order
+            (the states without values being last).
+        """
+
+        order = self.sorted_order()
+
+        return dict(zip(self.states[order], self.state_means[order].tolist()))
+
+
+    def state_mean(self, state):
+
+        """
+            It returns the mean of a state, NaN if the state has no values.
+        """
+
+        position = self.positions.get(state)
+
+        return math.nan if position is None else float(self.state_means[position])
+
+
+    def diffs_from_mean(self):
+
+        """
+            It returns the difference between the global mean and the mean of
+            every state, as a dict in ascending order of the state means.
+        """
+
+        order = self.sorted_order()
+        diffs = self.global_mean - self.state_means[order]
+
+        return dict(zip(self.states[order], diffs.tolist()))
+
+
+    def select(self, count, largest):
+
+        """
+            It returns the 'count' states with the smallest (or largest) means, in order,
+            using a partial selection instead of sorting all the states.
+            The states without values are ignored.
+        """
+
+        valid = np.flatnonzero(~np.isnan(self.state_means))
+        values = -self.state_means[valid] if largest else self.state_means[valid]
+
+        if count < len(values):
+            chosen = np.sort(np.argpartition(values, count - 1)[:count])
+        else:
+            chosen = np.arange(len(values))
+
+        positions = valid[chosen[np.argsort(values[chosen], kind = 'stable')]]
+
+        return dict(zip(self.states[positions], self.state_means[positions].tolist()))
+
+
+class QuestionStats:
+
+    """
+        It keeps the sum and the number of recorded values for a single question,
+        both per state and per (state, category, segment).
+        Every mean is derived from these tables, so no query has to scan the rows again.
+    """
+
+    def __init__(self, by_state, by_segment, total_sum, total_count):
+
+        """
+            It stores the aggregate tables of a question.
+            'by_state' is indexed by state, 'by_segment' by (state, category, segment),
+            both having a 'sum' and a 'count' column.
+        """
+
+        self.by_state = by_state
+        self.by_segment = by_segment
+        self.total_sum = total_sum
+        self.total_count = total_count
+        self.cached_summary = None
+
+
+    @classmethod
+    def empty(cls):
+
+        """
+            It creates the statistics of a question that has no recorded values.
+        """
+
+        by_state = pd.DataFrame(columns = AGGREGATES, dtype = float,
+                                index = pd.Index([], name = STATE_COLUMN))
+        by_segment = pd.DataFrame(columns = AGGREGATES, dtype = float,
+                                  index = pd.MultiIndex.from_tuples([], names = SEGMENT_COLUMNS))
+
+        return cls(by_state, by_segment, 0.0, 0)
+
+
+    def summary(self):
+
+        """
+            It returns the per-state summary of the question, computing it
+            on the first call only.
+        """
+
+        if self.cached_summary is None:
+            self.cached_summary = QuestionSummary(self)
+
+        return self.cached_summary
+
+
+    def global_mean(self):
+
+        """
+            It returns the average of all recorded values of the question.
+        """
+
+        if not self.total_count:
+            return math.nan
+
+        return self.total_sum / self.total_count
+
+
+    def segment_means(self):
+
+        """
+            It returns the average value of every (state, category, segment) as a pandas Series.
+        """
+
+        return self.by_segment['sum'] / self.by_segment['count']
+
+
+    def state_segment_means(self, state):
+
+        """
+            It returns the average value of every (category, segment) of a state
+            as a pandas Series.
+        """
+
+        if state not in self.by_segment.index:
+            return pd.Series(dtype = float)
+
+        state_segments = self.by_segment.loc[state]
+
+        return state_segments['sum'] / state_segments['count']
+
+
+    def memory_usage(self):
+
+        """
+            It returns the number of bytes used by the aggregate tables.
+        """
+
+        return int(self.by_state.memory_usage(deep = True).sum() +
+                   self.by_segment.memory_usage(deep = True).sum())
+
+
+EMPTY_STATS = QuestionStats.empty()
+
+
+def merge_question_stats(stats, added_stats):
+
+    """
+        It returns the statistics of a question after adding the rows aggregated
+        in 'added_stats', by adding up the sums and the counts of both tables.
+    """
+
+    return QuestionStats(
+        stats.by_state.add(added_stats.by_state, fill_value = 0).sort_index(),
+        stats.by_segment.add(added_stats.by_segment, fill_value = 0).sort_index(),
+        stats.total_sum + added_stats.total_sum,
+        stats.total_count + added_stats.total_count,
+    )
+
+
+def aggregate_levels(df):
+
+    """
+        It aggregates the values of the rows with a single groupby per level,
+        returning the (totals, by_state, by_segment) tables, all indexed by question first.
+        The string columns may be categorical, in which case the tables share
+        their dictionaries.
+    """
+
+    #  the sums are accumulated in float64 even if the values are stored as float32
+    values = df['Data_Value'].astype('float64')
+
+    def aggregate(columns):
+        keys = [df[column] for column in columns]
+        return values.groupby(keys, observed = True).agg(AGGREGATES)
+
+    return (aggregate(['Question']),
+            aggregate(['Question', STATE_COLUMN]),
+            aggregate(['Question'] + SEGMENT_COLUMNS))
+
+
+def split_question_index(totals, by_state, by_segment):
+
+    """
+        It partitions the aggregate tables by question, returning
+        a dict question -> QuestionStats.
+    """
+
+    states_per_question = dict(iter(by_state.groupby(level = 'Question', observed = True)))
+    segments_per_question = dict(iter(by_segment.groupby(level = 'Question', observed = True)))
+
+    index = {}
+
+    for question, (total_sum, total_count) in totals.iterrows():
+        question_states = states_per_question.get(question)
+        question_segments = segments_per_question.get(question)
+
+        index[question] = QuestionStats(
+            EMPTY_STATS.by_state if question_states is None else question_states.droplevel(0),
+            EMPTY_STATS.by_segment if question_segments is None else question_segments.droplevel(0),
+            float(total_sum),
+            int(total_count),
+        )
+
+    return index
+
+
+def build_question_index(df):
+
+    """
+        It partitions the rows by question and aggregates every partition
+        with a single groupby per level, returning a dict question -> QuestionStats.
+    """
+
+    return split_question_index(*aggregate_levels(df))
+
+
+def question_fingerprints(df):
+
+    """
+        It returns a dict question -> fingerprint of its rows, the sum of the hashes
+        of the rows, which does not depend on their order.
+        Two versions of the dataset giving the same fingerprint to a question
+        give it the same statistics too.
+    """
+
+    row_hashes = pd.util.hash_pandas_object(df[SEGMENT_COLUMNS + ['Data_Value']], index = False)
+    sums = row_hashes.groupby(df['Question'], observed = True).sum()
+
+    return {question: int(fingerprint) for question, fingerprint in sums.items()}
+
+
+def add_question_fingerprints(fingerprints, df):
+
+    """
+        It adds the fingerprints of the rows of a DataFrame to the fingerprints
+        of their questions, as if the rows had been fingerprinted together.
+    """
+
+    for question, rows_fingerprint in question_fingerprints(df).items():
+        fingerprints[question] = (fingerprints.get(question, 0) + rows_fingerprint) % (1 << 64)
@@ -0,0 +1,115 @@
+"""
+    This module implements a bounded cache for the results of the data ingestor queries.
+"""
+
+from collections import OrderedDict
+import threading
+
+MISSING = object()
+
+class ResultCache:
+
+    """
+        It keeps the JSON-encoded results of the queries, keyed by (task_type, args).
+        It is bounded both by the number of entries and by their size in bytes,
+        evicting the least recently used entries first.
+        It counts hits, misses and evictions.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+
+        """
+            It initializes an empty cache with the given limits.
+            The generation is increased on every invalidation, so that results
+            computed on an older dataset are not stored anymore.
+        """
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.current_bytes = 0
+        self.generation = 0
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+    def get(self, key):
+
+        """
+            It returns the cached result for a key, or MISSING if there is none.
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.counters["misses"] += 1
+                return MISSING
+
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+
+            return entry[0]
+
+
+    def put(self, key, result, generation):
+
+        """
+            It stores a result (bytes) computed during the given generation, evicting
+            the least recently used entries until the limits are respected.
+            Results larger than the whole cache are not stored.
+        """
+
+        size = len(result)
+
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            if key in self.entries:
+                self.current_bytes -= self.entries.pop(key)[1]
+
+            self.entries[key] = (result, size)
+            self.current_bytes += size
+
+            while len(self.entries) > self.max_entries or self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last = False)
+                self.current_bytes -= evicted_size
+                self.counters["evictions"] += 1
+
+
+    def invalidate(self, questions = None):
+
+        """
+            It drops all the cached results, for example when the dataset is reloaded,
+            or only the results of the given questions (the last argument of every query).
+        """
+
+        with self.lock:
+            if questions is None:
+                self.entries.clear()
+                self.current_bytes = 0
+            else:
+                for key in [key for key in self.entries if key[1][-1] in questions]:
+                    self.current_bytes -= self.entries.pop(key)[1]
+
+            self.generation += 1
+
+
+    def get_stats(self):
+
+        """
+            It returns the counters and the current usage of the cache.
+        """
+
+        with self.lock:
+            return {
+                **self.counters,
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+            }
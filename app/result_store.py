@@ -0,0 +1,264 @@
+"""
+    This module keeps the results of the jobs.
+
+    The results are stored already encoded as JSON bytes, so that they are
+    serialized only once and sent as they are to the clients.
+    There are three backends:
+        - 'file': one 'results/job_{job_id}.json' file per job (the original layout)
+        - 'memory': an in-memory store with a TTL and a size cap
+        - 'segment': an append-only log of segment files with an in-memory index
+"""
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import glob
+import os
+import threading
+import time
+
+
+class ResultStore(ABC):
+
+    """
+        It describes the interface of the result stores.
+    """
+
+    @abstractmethod
+    def put(self, job_id, payload):
+
+        """
+            It stores the JSON-encoded result (bytes) of a job,
+            replacing the previous one if there is one.
+        """
+
+
+    @abstractmethod
+    def get(self, job_id):
+
+        """
+            It returns the JSON-encoded result of a job, or None if it is not available.
+        """
+
+
+class FileResultStore(ResultStore):
+
+    """
+        It writes every result to its own 'job_{job_id}.json' file.
+    """
+
+    def __init__(self, directory):
+
+        """
+            It creates the results directory if it does not exist.
+        """
+
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok = True)
+
+
+    def put(self, job_id, payload):
+
+        """
+            It writes the result to a temporary file and renames it,
+            so that a reader never sees a half-written file.
+        """
+
+        filename = os.path.join(self.directory, f"job_{job_id}.json")
+
+        with open(filename + '.tmp', 'wb') as result_file:
+            result_file.write(payload)
+
+        os.replace(filename + '.tmp', filename)
+
+
+    def get(self, job_id):
+
+        """
+            It reads the result file of a job.
+        """
+
+        try:
+            with open(os.path.join(self.directory, f"job_{job_id}.json"), 'rb') as result_file:
+                return result_file.read()
+        except FileNotFoundError:
+            return None
+
+
+class MemoryResultStore(ResultStore):
+
+    """
+        It keeps the results in memory for 'ttl' seconds, dropping the oldest
+        ones when their total size exceeds 'max_bytes'.
+    """
+
+    def __init__(self, ttl, max_bytes):
+
+        """
+            It initializes an empty store, ordered by insertion time.
+        """
+
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.results = OrderedDict()
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+
+
+    def put(self, job_id, payload):
+
+        """
+            It stores a result and drops the expired and the oldest results.
+            A result stored again replaces the previous one and becomes the newest.
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            previous = self.results.pop(job_id, None)
+            if previous is not None:
+                self.current_bytes -= len(previous[1])
+
+            self.results[job_id] = (now + self.ttl, payload)
+            self.current_bytes += len(payload)
+
+            while self.results:
+                oldest_id, (expires_at, oldest_payload) = next(iter(self.results.items()))
+                if expires_at > now and self.current_bytes <= self.max_bytes:
+                    break
+
+                del self.results[oldest_id]
+                self.current_bytes -= len(oldest_payload)
+
+
+    def get(self, job_id):
+
+        """
+            It returns a result if it has not expired.
+        """
+
+        with self.lock:
+            entry = self.results.get(job_id)
+
+        if entry is None or entry[0] < time.monotonic():
+            return None
+
+        return entry[1]
+
+
+class SegmentLogResultStore(ResultStore):   # pylint: disable=too-many-instance-attributes
+
+    """
+        It appends the results to segment files, keeping in memory only
+        the position of every result.
+        A new segment is started when the current one exceeds 'segment_bytes',
+        and only the last 'max_segments' segments are kept.
+    """
+
+    def __init__(self, directory, segment_bytes, max_segments):
+
+        """
+            It removes the segments of a previous run (the job ids start again from 1)
+            and opens the first segment.
+        """
+
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        self.positions = {}
+        self.segments = OrderedDict()
+
+        os.makedirs(self.directory, exist_ok = True)
+        for old_segment in glob.glob(os.path.join(self.directory, 'segment_*.log')):
+            os.remove(old_segment)
+
+        self.segment_id = -1
+        self.segment_file = None
+        self.open_segment()
+
+
+    def open_segment(self):
+
+        """
+            It starts a new segment and drops the oldest one if there are too many.
+            It must be called with the lock held.
+        """
+
+        if self.segment_file is not None:
+            self.segment_file.close()
+
+        self.segment_id += 1
+        path = os.path.join(self.directory, f"segment_{self.segment_id}.log")
+        self.segment_file = open(path, 'ab')   # pylint: disable=consider-using-with
+        self.segments[self.segment_id] = (path, [])
+
+        while len(self.segments) > self.max_segments:
+            _, (old_path, old_job_ids) = self.segments.popitem(last = False)
+            for job_id in old_job_ids:
+                #  a result stored again is in a newer segment
+                if self.positions.get(job_id, (None,))[0] == old_path:
+                    del self.positions[job_id]
+            os.remove(old_path)
+
+
+    def put(self, job_id, payload):
+
+        """
+            It appends a result to the current segment.
+        """
+
+        with self.lock:
+            offset = self.segment_file.tell()
+            self.segment_file.write(payload)
+            self.segment_file.flush()
+
+            path, job_ids = self.segments[self.segment_id]
+            job_ids.append(job_id)
+            self.positions[job_id] = (path, offset, len(payload))
+
+            if offset + len(payload) >= self.segment_bytes:
+                self.open_segment()
+
+
+    def get(self, job_id):
+
+        """
+            It reads a result from its segment.
+        """
+
+        with self.lock:
+            position = self.positions.get(job_id)
+
+            if position is None:
+                return None
+
+            path, offset, length = position
+            #  the segment is opened under the lock, so that it is not removed before
+            segment = open(path, 'rb')   # pylint: disable=consider-using-with
+
+        with segment:
+            segment.seek(offset)
+            return segment.read(length)
+
+
+def create_result_store(kind, directory = 'results'):
+
+    """
+        It creates the result store of the given kind ('file', 'memory' or 'segment'),
+        configured from the environment.
+    """
+
+    if kind == 'memory':
+        return MemoryResultStore(float(os.getenv("TP_RESULT_TTL", "3600")),
+                                 int(os.getenv("TP_RESULT_MAX_BYTES", str(256 * 1024 * 1024))))
+
+    if kind == 'segment':
+        return SegmentLogResultStore(directory,
+                                     int(os.getenv("TP_RESULT_SEGMENT_BYTES",
+                                                   str(64 * 1024 * 1024))),
+                                     int(os.getenv("TP_RESULT_MAX_SEGMENTS", "16")))
+
+    if kind == 'file':
+        return FileResultStore(directory)
+
+    raise ValueError(f"Unknown result store: {kind}")
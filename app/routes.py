@@ -2,10 +2,48 @@
     This module contains the logic for processing API endpoints requests.
 """
 
+import os
 import json
-from flask import request, jsonify
+import itertools
+from flask import request, jsonify, Response
 from app import webserver
-from .webserver_log import logger
+from .webserver_log import logger, get_log_stats
+from .result_cache import MISSING
+from .job_registry import STATUSES, FINISHED_STATUSES
+from .scheduler import PRIORITY_CLASSES
+from .admission import retry_after_header
+from .profiler import profiler, collapse
+
+#  default time budget (in milliseconds) of the requests asking for a synchronous response
+SYNC_BUDGET_MS = float(os.getenv("SYNC_BUDGET_MS", "5"))
+
+#  whether the X-Client-Id header is set by a trusted proxy, so that the rate limits
+#  may be applied to it instead of the address of the client
+TRUST_CLIENT_ID = os.getenv("TP_TRUST_CLIENT_ID", "0") == "1"
+
+#  whether /api/append_rows may change the dataset (it is disabled by default)
+APPEND_ROWS_ENABLED = os.getenv("DATA_APPEND_ROWS", "0") == "1"
+
+#  whether /api/reload_dataset may reload the dataset (it is disabled by default)
+RELOAD_ENABLED = os.getenv("DATA_RELOAD", "0") == "1"
+
+#  whether /api/profile may be used (it is disabled by default)
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "0") == "1"
+
+#  longest time (in seconds) a get_results request may wait for its job
+LONG_POLL_MAX_SECONDS = float(os.getenv("LONG_POLL_MAX_SECONDS", "30"))
+
+#  interval (in seconds) of the keepalive comments sent on /api/events
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+
+#  number of jobs serialized at once by /api/jobs
+JOBS_CHUNK_SIZE = 1000
+
+#  endpoints that need a state besides the question
+STATE_ENDPOINTS = ["state_mean", "state_diff_from_mean", "state_mean_by_category"]
+
+#  largest number of items of a batch request
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
 
 # Example endpoint definition
 @webserver.route('/api/post_endpoint', methods=['POST'])
@@ -32,36 +70,182 @@ def post_endpoint():
     return jsonify({"error": "Method not allowed"}), 405
 
 
+def done_response(payload):
+
+    """
+        This function wraps an already JSON-encoded result in a 'done' response,
+        without decoding it again.
+    """
+
+    return Response(b'{"status": "done", "data": ' + payload + b'}',
+                    mimetype = 'application/json')
+
+
+def overloaded_response(status_code, reason, retry_after):
+
+    """
+        This function rejects a submission with the given HTTP status (429 or 503)
+        and a Retry-After hint.
+    """
+
+    logger.error("Rejected submission: %s", reason)
+
+    response = jsonify({"status": "error", "reason": reason})
+    response.status_code = status_code
+    response.headers["Retry-After"] = retry_after_header(retry_after)
+
+    return response
+
+
+def submit_job(task_type, args, data):
+
+    """
+        This function submits a job and returns its job_id.
+        If the client asked for a synchronous response ("sync": true in the request
+        or ?sync=1), the result is returned directly when it is cached or when the task
+        usually fits in the time budget ("budget_ms", SYNC_BUDGET_MS by default).
+        Only the tasks whose arguments are strings are computed inline; the other ones
+        get a job_id, and their job fails like any other invalid task.
+        The job is scheduled in the "priority" class of the request ("high", "normal"
+        or "low", by default the class of the task type), fairly with the jobs of
+        the other clients (identified by the X-Client-Id header or their address).
+        The rate limits apply to the address of the client (to the X-Client-Id header
+        only behind a trusted proxy, TP_TRUST_CLIENT_ID=1), since any client may set
+        the header. A client over its rate limit gets a 429 response and, when the queue is full,
+        the job is rejected with a 503 response, both with a Retry-After header.
+    """
+
+    client = request.headers.get("X-Client-Id", request.remote_addr)
+    rate_client = client if TRUST_CLIENT_ID else request.remote_addr
+
+    retry_after = webserver.tasks_runner.admission.check_rate(rate_client)
+    if retry_after is not None:
+        return overloaded_response(429, "Too many requests", retry_after)
+
+    if data.get("sync") or request.args.get("sync") == "1":
+        try:
+            budget_ms = float(data.get("budget_ms", SYNC_BUDGET_MS))
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "reason": "Invalid budget_ms"})
+
+        result = MISSING
+        if all(isinstance(arg, str) for arg in args):
+            result = webserver.tasks_runner.execute(task_type, args, budget = budget_ms / 1000)
+
+        if result is not MISSING:
+            return done_response(result)
+
+    priority = data.get("priority")
+    if priority is not None and priority not in PRIORITY_CLASSES:
+        return jsonify({"status": "error", "reason": "Invalid priority"})
+
+    retry_after = webserver.tasks_runner.check_queue_depth()
+    if retry_after is not None:
+        return overloaded_response(503, "Server overloaded", retry_after)
+
+    job_id = webserver.tasks_runner.submit(task_type, args, priority, client)
+
+    return jsonify({"job_id": job_id})
+
+
+def job_result(job_id):
+
+    """
+        This function returns the response body (bytes) of a finished job: its result,
+        or an error if the job failed or its result is no longer available.
+    """
+
+    job_status = webserver.tasks_runner.get_job_status(job_id)
+    if job_status is not None and job_status["status"] == "failed":
+        return json.dumps({"status": "error", "reason": "Job failed"}).encode()
+
+    result = webserver.tasks_runner.result_store.get(job_id)
+
+    if result is None:
+        logger.error("Result of job_id %d is no longer available", job_id)
+        return json.dumps({"status": "error", "reason": "Result expired"}).encode()
+
+    return b'{"status": "done", "data": ' + result + b'}'
+
+
 @webserver.route('/api/get_results/<job_id>', methods=['GET'])
 def get_response(job_id):
 
     """
         This function handle API requests for getting results from a job_id.
         It receives a job_id and returns the status of processing that job.
+        With ?wait=<seconds> (at most LONG_POLL_MAX_SECONDS), the request blocks
+        until the job is completed or the time passes.
     """
 
     if request.method == 'GET':
-        logger.info("Hopefully get results from {'job_id': %s}", job_id)
+        logger.info("Hopefully get results from {'job_id': %s}", job_id,
+                    extra = {"sampled": True})
 
         job_id = int(job_id)
+        job_registry = webserver.tasks_runner.job_registry
 
-        if job_id > int(webserver.job_counter) or job_id < 1:
+        if job_id > job_registry.num_jobs() or job_id < 1:
             logger.error("Invalid job_id: %d", job_id)
             return jsonify({"status": "error", "reason": "Invalid job_id"})
 
+        try:
+            wait = min(float(request.args.get("wait", "0")), LONG_POLL_MAX_SECONDS)
+        except ValueError:
+            return jsonify({"status": "error", "reason": "Invalid wait"})
+
+        if wait > 0:
+            job_registry.wait_completed([job_id], wait)
+
         job_status = webserver.tasks_runner.get_job_status(job_id)
 
-        if job_status and job_status["status"] == "completed":
-            with open(f'results/job_{job_id}.json', 'r', encoding = 'utf-8') as file:
-                try:
-                    result = json.load(file)
-                    return jsonify({"status": "done", "data": result})
-                except json.JSONDecodeError:
-                    return jsonify({"status": "running"})
-        else:
-            return jsonify({"status": "running"})
-    else:
-        return jsonify({"error": "Method not allowed"}), 405
+        if job_status and job_status["status"] in FINISHED_STATUSES:
+            return Response(job_result(job_id), mimetype = 'application/json')
+
+        return jsonify({"status": "running"})
+
+    return jsonify({"error": "Method not allowed"}), 405
+
+
+@webserver.route('/api/events', methods=['GET'])
+def get_events():
+
+    """
+        This function streams the results of a set of jobs (?job_ids=1,2,3) as
+        server-sent events, each one sent as soon as its job is completed.
+        Every event has the job_id as its id and the get_results response as its data.
+        A comment is sent every SSE_KEEPALIVE_SECONDS while no job completes, and
+        the stream ends after the last job.
+    """
+
+    if request.method == 'GET':
+        logger.info("Streaming events for {'job_ids': %s}", request.args.get("job_ids"))
+
+        job_registry = webserver.tasks_runner.job_registry
+
+        try:
+            job_ids = {int(job_id) for job_id in request.args.get("job_ids", "").split(",")}
+        except ValueError:
+            return jsonify({"status": "error", "reason": "Invalid job_id"})
+
+        if any(job_id > job_registry.num_jobs() or job_id < 1 for job_id in job_ids):
+            return jsonify({"status": "error", "reason": "Invalid job_id"})
+
+        def generate_events():
+            while job_ids:
+                completed = job_registry.wait_completed(sorted(job_ids), SSE_KEEPALIVE_SECONDS)
+
+                if not completed:
+                    yield b": keepalive\n\n"
+
+                for job_id in completed:
+                    job_ids.remove(job_id)
+                    yield f"id: {job_id}\nevent: result\ndata: ".encode() + \
+                        job_result(job_id) + b"\n\n"
+
+        return Response(generate_events(), mimetype = 'text/event-stream')
+
+    return jsonify({"error": "Method not allowed"}), 405
 
 
 @webserver.route('/api/states_mean', methods=['POST'])
@@ -82,11 +266,7 @@ def states_mean_request():
         data = request.json
         logger.info("Got request data: %s for hopefully get_states_mean", data)
 
-        job_id = webserver.job_counter
-        webserver.job_counter += 1
-        webserver.tasks_runner.submit("get_states_mean", [data["question"]], job_id)
-
-        return jsonify({"job_id": job_id})
+        return submit_job("get_states_mean", [data["question"]], data)
 
     return jsonify({"error": "Method not allowed"}), 405
 
@@ -109,11 +289,7 @@ def state_mean_request():
         data = request.json
         logger.info("Got request data: %s for hopefully get_state_mean", data)
 
-        job_id = webserver.job_counter
-        webserver.job_counter += 1
-        webserver.tasks_runner.submit("get_state_mean", [data["state"], data["question"]], job_id)
-
-        return jsonify({"job_id": job_id})
+        return submit_job("get_state_mean", [data["state"], data["question"]], data)
 
     return jsonify({"error": "Method not allowed"}), 405
 
@@ -136,11 +312,7 @@ def best5_request():
         data = request.json
         logger.info("Got request data: %s for hopefully get_best5", data)
 
-        job_id = webserver.job_counter
-        webserver.job_counter += 1
-        webserver.tasks_runner.submit("get_best5", [data["question"]], job_id)
-
-        return jsonify({"job_id": job_id})
+        return submit_job("get_best5", [data["question"]], data)
 
     return jsonify({"error": "Method not allowed"}), 405
 
@@ -164,11 +336,7 @@ def worst5_request():
         data = request.json
         logger.info("Got request data: %s for hopefully get_worst5", data)
 
-        job_id = webserver.job_counter
-        webserver.job_counter += 1
-        webserver.tasks_runner.submit("get_worst5", [data["question"]], job_id)
-
-        return jsonify({"job_id": job_id})
+        return submit_job("get_worst5", [data["question"]], data)
 
     return jsonify({"error": "Method not allowed"}), 405
 
@@ -191,11 +359,7 @@ def global_mean_request():
         data = request.json
         logger.info("Got request data: %s for hopefully get_global_mean", data)
 
-        job_id = webserver.job_counter
-        webserver.job_counter += 1
-        webserver.tasks_runner.submit("get_global_mean", [data["question"]], job_id)
-
-        return jsonify({"job_id": job_id})
+        return submit_job("get_global_mean", [data["question"]], data)
 
     return jsonify({"error": "Method not allowed"}), 405
 
@@ -218,11 +382,7 @@ def diff_from_mean_request():
         data = request.json
         logger.info("Got request data: %s for hopefully get_diff_from_mean", data)
 
-        job_id = webserver.job_counter
-        webserver.job_counter += 1
-        webserver.tasks_runner.submit("get_diff_from_mean", [data["question"]], job_id)
-
-        return jsonify({"job_id": job_id})
+        return submit_job("get_diff_from_mean", [data["question"]], data)
 
     return jsonify({"error": "Method not allowed"}), 405
 
@@ -245,12 +405,8 @@ def state_diff_from_mean_request():
         data = request.json
         logger.info("Got request data: %s for hopefully get_diff_from_mean", data)
 
-        job_id = webserver.job_counter
-        webserver.job_counter += 1
-        webserver.tasks_runner.submit("get_state_diff_from_mean",
-                                      [data["state"], data["question"]], job_id)
-
-        return jsonify({"job_id": job_id})
+        return submit_job("get_state_diff_from_mean",
+                          [data["state"], data["question"]], data)
 
     return jsonify({"error": "Method not allowed"}), 405
 
@@ -273,11 +429,7 @@ def mean_by_category_request():
         data = request.json
         logger.info("Got request data: %s for hopefully get_mean_by_category", data)
 
-        job_id = webserver.job_counter
-        webserver.job_counter += 1
-        webserver.tasks_runner.submit("get_mean_by_category", [data["question"]], job_id)
-
-        return jsonify({"job_id": job_id})
+        return submit_job("get_mean_by_category", [data["question"]], data)
 
     return jsonify({"error": "Method not allowed"}), 405
 
@@ -300,12 +452,70 @@ def state_mean_by_category_request():
         data = request.json
         logger.info("Got request data: %s for hopefully get_state_mean_by_category", data)
 
-        job_id = webserver.job_counter
-        webserver.job_counter += 1
-        webserver.tasks_runner.submit("get_state_mean_by_category",
-                                     [data["state"], data["question"]], job_id)
+        return submit_job("get_state_mean_by_category",
+                          [data["state"], data["question"]], data)
+
+    return jsonify({"error": "Method not allowed"}), 405
+
+
+def batch_queries(items):
+
+    """
+        This function returns the [task_type, args] queries of the items of a batch,
+        or None if they are not a list of at most BATCH_MAX_ITEMS valid items.
+    """
+
+    if not isinstance(items, list) or len(items) > BATCH_MAX_ITEMS:
+        return None
+
+    queries = []
+
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("question"), str):
+            return None
+
+        task_type = "get_" + str(item.get("endpoint"))
+        if task_type not in webserver.tasks_runner.tasks_dict:
+            return None
+
+        if item["endpoint"] in STATE_ENDPOINTS:
+            if not isinstance(item.get("state"), str):
+                return None
+            queries.append([task_type, [item["state"], item["question"]]])
+        else:
+            queries.append([task_type, [item["question"]]])
+
+    return queries
+
 
-        return jsonify({"job_id": job_id})
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+
+    """
+        This function should no longer receive POST requests if the webserver
+        is shutting down.
+        It handles API requests containing many queries, given as a list of
+        {"endpoint", "question", "state"} items, the state being needed only
+        by the state_* endpoints.
+        It returns a single job_id, whose result is the list of the results.
+        At most BATCH_MAX_ITEMS items are accepted.
+    """
+
+    if getattr(webserver, 'shutting_down', False):
+        logger.error("Server is shutting down")
+        return jsonify({"status": "error", "reason": "shutting down"})
+
+    if request.method == 'POST':
+        data = request.json
+        items = data.get("items", []) if isinstance(data, dict) else None
+        logger.info("Got batch request with items: %.200s", items)
+
+        queries = batch_queries(items)
+        if queries is None:
+            logger.error("Invalid batch items: %.200s", items)
+            return jsonify({"status": "error", "reason": "Invalid batch item"})
+
+        return submit_job("batch", [queries], data)
 
     return jsonify({"error": "Method not allowed"}), 405
 
@@ -337,18 +547,167 @@ def get_all_jobs():
     """
         This function return the status and its corresponding id for
         each job.
+        The jobs can be paginated (?cursor=<last seen job_id>&limit=<count>) and
+        filtered (?status=...&task_type=...). When a limit is given, the response
+        also contains the 'next_cursor', null on the last page.
+        With ?format=ndjson, every job is sent on its own line, followed by
+        a line with the 'next_cursor'.
+        The response is streamed in chunks, so it is never built
+        entirely in memory.
     """
 
     if request.method == 'GET':
         logger.info("Getting all jobs")
 
-        jobs_data = []
+        try:
+            cursor = int(request.args.get("cursor", "0"))
+            limit = request.args.get("limit")
+            limit = None if limit is None else int(limit)
+        except ValueError:
+            return jsonify({"status": "error", "reason": "Invalid cursor or limit"})
+
+        status = request.args.get("status")
+        if status is not None and status not in STATUSES:
+            return jsonify({"status": "error", "reason": "Invalid status"})
+
+        ndjson = request.args.get("format") == "ndjson"
+
+        jobs = webserver.tasks_runner.job_registry.scan(cursor, status,
+                                                        request.args.get("task_type"),
+                                                        JOBS_CHUNK_SIZE)
+        if limit is not None:
+            jobs = itertools.islice(jobs, max(limit, 0))
+
+        def generate_jobs():
+            returned_jobs = 0
+            last_job_id = None
+
+            if not ndjson:
+                yield '{"status": "done", "data": ['
+
+            for chunk in iter(lambda: list(itertools.islice(jobs, JOBS_CHUNK_SIZE)), []):
+                lines = [json.dumps({str(job_id): job_status}) for job_id, job_status in chunk]
+
+                if ndjson:
+                    yield "".join(line + "\n" for line in lines)
+                else:
+                    yield (", " if returned_jobs else "") + ", ".join(lines)
+
+                returned_jobs += len(chunk)
+                last_job_id = chunk[-1][0]
+
+            #  a full page may be followed by more jobs, a shorter one is the last
+            next_cursor = last_job_id if limit and returned_jobs == limit else None
+
+            if ndjson:
+                yield json.dumps({"next_cursor": next_cursor}) + "\n"
+            elif limit is not None:
+                yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+            else:
+                yield ']}'
+
+        return Response(generate_jobs(),
+                        mimetype = 'application/x-ndjson' if ndjson else 'application/json')
+
+    return jsonify({"error": "Method not allowed"}), 405
+
+
+@webserver.route('/api/cache_stats', methods = ['GET'])
+def get_cache_stats():
+
+    """
+        This function returns the hit, miss and eviction counters of
+        the results cache and, with TP_MATERIALIZE=1, the size of the materialized
+        results and the time building them took.
+    """
+
+    if request.method == 'GET':
+        cache_stats = webserver.tasks_runner.result_cache.get_stats()
+
+        if webserver.tasks_runner.materializer is not None:
+            cache_stats["materialized"] = webserver.tasks_runner.materializer.get_stats()
+
+        return jsonify({"status": "done", "data": cache_stats})
+
+    return jsonify({"error": "Method not allowed"}), 405
+
+
+@webserver.route('/api/reload_dataset', methods = ['GET', 'POST'])
+def reload_dataset_request():
+
+    """
+        This function starts reloading the dataset in the background (POST),
+        or returns the status of the last reload (GET).
+        The jobs submitted before the new dataset is set are still computed
+        on the previous one.
+        A reload parses the csv and forks the worker processes again, so any client
+        could overload the server with it: it is disabled unless DATA_RELOAD=1.
+    """
+
+    if request.method == 'POST':
+        if not RELOAD_ENABLED:
+            logger.error("Reloading the dataset is disabled")
+            return jsonify({"status": "error", "reason": "Reloading the dataset is disabled"}), 403
+
+        logger.info("Reloading the dataset")
+
+        if not webserver.dataset_reloader.reload():
+            return jsonify({"status": "error", "reason": "Reload already in progress"})
 
-        for job_id in range(1, webserver.job_counter):
-            job_status = webserver.tasks_runner.get_job_status(job_id)
-            jobs_data.append({str(job_id): job_status})
+        return jsonify({"status": "reloading"})
 
-        return jsonify({"status": "done", "data": jobs_data})
+    if request.method == 'GET':
+        return jsonify({"status": "done", "data": webserver.dataset_reloader.status})
+
+    return jsonify({"error": "Method not allowed"}), 405
+
+
+@webserver.route('/api/append_rows', methods = ['POST'])
+def append_rows_request():
+
+    """
+        This function adds rows to the dataset, given either as JSON
+        ({"rows": [{column: value, ...}, ...]}) or as a csv chunk with a header
+        (Content-Type: text/csv). The following queries include them.
+        Any client could change the results of the others, so the endpoint
+        is disabled unless DATA_APPEND_ROWS=1.
+    """
+
+    if request.method == 'POST':
+        if not APPEND_ROWS_ENABLED:
+            logger.error("Appending rows is disabled")
+            return jsonify({"status": "error", "reason": "Appending rows is disabled"}), 403
+
+        logger.info("Appending rows to the dataset")
+
+        if request.mimetype == 'text/csv':
+            rows = request.get_data(as_text = True)
+        else:
+            rows = (request.get_json(silent = True) or {}).get("rows")
+            if not isinstance(rows, list):
+                return jsonify({"status": "error", "reason": "Invalid rows"})
+
+        try:
+            changed_questions = webserver.tasks_runner.append_rows(rows)
+        except ValueError as error:
+            logger.error("Invalid rows: %s", error)
+            return jsonify({"status": "error", "reason": "Invalid rows"})
+
+        return jsonify({"status": "done", "data": {"questions": sorted(changed_questions)}})
+
+    return jsonify({"error": "Method not allowed"}), 405
+
+
+@webserver.route('/api/log_stats', methods = ['GET'])
+def get_log_stats_request():
+
+    """
+        This function returns the number of log records dropped because the
+        logging queue was full, skipped by sampling and waiting to be written.
+    """
+
+    if request.method == 'GET':
+        return jsonify({"status": "done", "data": get_log_stats()})
 
     return jsonify({"error": "Method not allowed"}), 405
 
@@ -360,12 +719,101 @@ def get_num_jobs():
         This function should return the number of remaining jobs
         to process. After shutting down the webserver and after 
         a specific time, the server could be stopped completely.
+        The remaining jobs are the tasks waiting in the queue, as before; the
+        unfinished jobs also count the jobs being processed and the jobs attached
+        to identical ones (the pending and processing jobs of the registry).
+        It also returns the percentiles of the recent queue wait times, the number of
+        rejected submissions and the depth and the wait times of every priority class.
     """
 
     if request.method == 'GET':
+        job_registry = webserver.tasks_runner.job_registry
         remaining_jobs = webserver.tasks_runner.tasks_queue.qsize()
+        unfinished_jobs = job_registry.count("pending") + job_registry.count("processing")
+
+        return jsonify({"status": "done", "remaining_jobs": remaining_jobs,
+                        "unfinished_jobs": unfinished_jobs,
+                        "coalesced_jobs": webserver.tasks_runner.coalesced_jobs,
+                        "wait_seconds": webserver.tasks_runner.tasks_queue.get_wait_percentiles(),
+                        "admission": webserver.tasks_runner.admission.get_stats(),
+                        "queues": webserver.tasks_runner.tasks_queue.get_stats()})
+
+    return jsonify({"error": "Method not allowed"}), 405
+
+
+@webserver.route('/api/metrics', methods = ['GET'])
+def get_metrics():
+
+    """
+        This function returns the latency histograms of the tasks, the utilization
+        of the task runners and the counters of the other stats endpoints,
+        in the Prometheus text format.
+    """
+
+    if request.method == 'GET':
+        tasks_runner = webserver.tasks_runner
+        queues = tasks_runner.tasks_queue.get_stats()
+
+        gauges = {
+            "tp_jobs": ("Jobs by status",
+                        {f'status="{status}"': tasks_runner.job_registry.count(status)
+                         for status in STATUSES}),
+            "tp_coalesced_jobs": ("Jobs attached to an identical job",
+                                  {"": tasks_runner.coalesced_jobs}),
+            "tp_queue_depth": ("Tasks waiting, by priority class",
+                               {f'priority="{priority}"': queues[priority]["depth"]
+                                for priority in PRIORITY_CLASSES}),
+            "tp_admission_rejected": ("Rejected submissions",
+                                      {f'reason="{reason}"': count for reason, count
+                                       in tasks_runner.admission.get_stats().items()
+                                       if reason in ("rate_limited", "queue_full")}),
+            "tp_result_cache": ("Counters and usage of the results cache",
+                                {f'stat="{stat}"': value for stat, value
+                                 in tasks_runner.result_cache.get_stats().items()}),
+            "webserver_log_records": ("Log records not written yet or not at all",
+                                      {f'stat="{stat}"': value
+                                       for stat, value in get_log_stats().items()}),
+        }
+
+        return Response(tasks_runner.metrics.export(gauges),
+                        mimetype = 'text/plain; version=0.0.4')
+
+    return jsonify({"error": "Method not allowed"}), 405
+
+
+@webserver.route('/api/profile', methods = ['GET'])
+def get_profile():
+
+    """
+        This function samples the stacks of the task runners and of the request
+        threads (all the threads with ?all=1) every ?interval_ms=<milliseconds>
+        (10 by default) for ?seconds=<seconds> (5 by default, at most PROFILE_MAX_SECONDS)
+        and returns them as collapsed stacks, ready for a flamegraph.
+        A profile keeps a request thread busy, blocks the other profiles and shows
+        the layout of the code, so the endpoint is disabled unless PROFILE_ENABLED=1.
+    """
+
+    if request.method == 'GET':
+        if not PROFILE_ENABLED:
+            logger.error("Profiling is disabled")
+            return jsonify({"status": "error", "reason": "Profiling is disabled"}), 403
+
+        try:
+            seconds = float(request.args.get("seconds", "5"))
+            interval = float(request.args.get("interval_ms", "10")) / 1000
+        except ValueError:
+            return jsonify({"status": "error", "reason": "Invalid profile duration"})
+
+        logger.info("Profiling for %s seconds", seconds)
+
+        profile = profiler.profile(seconds, interval, request.args.get("all") == "1")
+        if profile is None:
+            return jsonify({"status": "error", "reason": "Profile already in progress"})
+
+        stacks, samples = profile
 
-        return jsonify({"status": "done", "remaining_jobs": remaining_jobs})
+        return Response(collapse(stacks), mimetype = 'text/plain',
+                        headers = {"X-Profile-Samples": str(samples)})
 
     return jsonify({"error": "Method not allowed"}), 405
 
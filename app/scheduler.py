@@ -0,0 +1,240 @@
+"""
+    This module schedules the tasks waiting to be executed by the task runners.
+"""
+
+from collections import deque
+from queue import Empty
+import threading
+import time
+
+#  the priority classes, from the one served first
+PRIORITY_CLASSES = ["high", "normal", "low"]
+
+#  the class of the tasks submitted without an explicit priority: the lookups of a
+#  single value first, the tables of all the segments and the batches last
+DEFAULT_PRIORITIES = {
+    "get_state_mean": "high",
+    "get_global_mean": "high",
+    "get_state_diff_from_mean": "high",
+    "get_mean_by_category": "low",
+    "get_state_mean_by_category": "low",
+    "batch": "low",
+}
+
+#  the cost (in seconds) of a task type which has not been executed yet
+DEFAULT_COST = 0.001
+
+#  number of recent wait times kept per class for the percentiles
+RECENT_WAITS = 1024
+
+
+def wait_percentiles(waits):
+
+    """
+        It returns the 50th, 95th and 99th percentiles (nearest rank) of the wait times.
+    """
+
+    waits = sorted(waits)
+
+    if not waits:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+
+    return {f"p{percentile}": waits[min(len(waits) - 1, len(waits) * percentile // 100)]
+            for percentile in (50, 95, 99)}
+
+
+class ClassQueue:
+
+    """
+        It keeps the tasks of a priority class, one queue per client, and serves
+        the clients with deficit round robin: at every turn, a client receives a quantum
+        of execution time and runs the tasks which fit in it, so a client with many
+        expensive tasks cannot starve the clients with a few cheap ones.
+    """
+
+    def __init__(self):
+
+        """
+            It initializes an empty class and its counters.
+        """
+
+        self.clients = {}
+        self.deficits = {}
+        self.active_clients = deque()
+        self.depth = 0
+        self.counters = {"submitted": 0, "served": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+        self.recent_waits = deque(maxlen = RECENT_WAITS)
+
+
+    def put(self, entry, client):
+
+        """
+            It adds a (task, cost, enqueue time) entry to the queue of its client.
+        """
+
+        if client not in self.clients:
+            self.clients[client] = deque()
+            self.deficits[client] = 0.0
+            self.active_clients.append(client)
+
+        self.clients[client].append(entry)
+        self.depth += 1
+        self.counters["submitted"] += 1
+
+
+    def get(self, quantum):
+
+        """
+            It removes and returns the next task, giving a quantum to every
+            client whose next task does not fit in its deficit.
+        """
+
+        while True:
+            client = self.active_clients[0]
+            client_queue = self.clients[client]
+            task, cost, enqueue_time = client_queue[0]
+
+            if self.deficits[client] < cost:
+                self.deficits[client] += quantum
+                self.active_clients.rotate(-1)
+                continue
+
+            client_queue.popleft()
+            self.deficits[client] -= cost
+            self.depth -= 1
+
+            if not client_queue:
+                #  an idle client does not keep its deficit
+                del self.clients[client]
+                del self.deficits[client]
+                self.active_clients.popleft()
+
+            wait_seconds = time.monotonic() - enqueue_time
+            self.counters["served"] += 1
+            self.counters["wait_seconds"] += wait_seconds
+            self.counters["max_wait_seconds"] = max(self.counters["max_wait_seconds"],
+                                                    wait_seconds)
+            self.recent_waits.append(wait_seconds)
+
+            return task
+
+
+    def get_stats(self):
+
+        """
+            It returns the depth, the counters and the wait times of the class,
+            the percentiles being computed on the last RECENT_WAITS tasks.
+        """
+
+        served = self.counters["served"]
+
+        return {
+            "depth": self.depth,
+            "clients": len(self.clients),
+            "submitted": self.counters["submitted"],
+            "served": served,
+            "mean_wait_seconds": self.counters["wait_seconds"] / served if served else 0.0,
+            "max_wait_seconds": self.counters["max_wait_seconds"],
+            "wait_seconds": wait_percentiles(self.recent_waits),
+        }
+
+
+class FairScheduler:
+
+    """
+        It replaces the FIFO queue of the tasks. The priority classes are served
+        in order and, inside a class, the clients share the task runners fairly,
+        each task counting for the average execution time of its type.
+        It has the get / empty / qsize methods of a Queue.
+    """
+
+    def __init__(self, task_costs):
+
+        """
+            It initializes the classes, the costs being read from 'task_costs'.
+        """
+
+        self.task_costs = task_costs
+        self.classes = {priority: ClassQueue() for priority in PRIORITY_CLASSES}
+        self.not_empty = threading.Condition()
+        self.size = 0
+
+
+    def put(self, task, task_type, priority = None, client = None):
+
+        """
+            It adds a task of the given type, in the given priority class (by default,
+            the class of its type), on behalf of the given client.
+        """
+
+        if priority is None:
+            priority = DEFAULT_PRIORITIES.get(task_type, "normal")
+
+        cost = self.task_costs.get(task_type) or DEFAULT_COST
+
+        with self.not_empty:
+            self.classes[priority].put((task, cost, time.monotonic()), client)
+            self.size += 1
+            self.not_empty.notify()
+
+
+    def get(self, timeout = None):
+
+        """
+            It removes and returns the next task, waiting at most 'timeout' seconds
+            for one, after which it raises Empty.
+        """
+
+        with self.not_empty:
+            if not self.not_empty.wait_for(lambda: self.size > 0, timeout):
+                raise Empty
+
+            #  a turn is long enough for the most expensive task known
+            quantum = max(DEFAULT_COST, self.task_costs.get_max())
+
+            for class_queue in self.classes.values():
+                if class_queue.depth:
+                    self.size -= 1
+                    return class_queue.get(quantum)
+
+        raise Empty
+
+
+    def empty(self):
+
+        """
+            It returns True if there is no waiting task.
+        """
+
+        return self.size == 0
+
+
+    def qsize(self):
+
+        """
+            It returns the number of waiting tasks.
+        """
+
+        return self.size
+
+
+    def get_stats(self):
+
+        """
+            It returns the statistics of every priority class.
+        """
+
+        with self.not_empty:
+            return {priority: class_queue.get_stats()
+                    for priority, class_queue in self.classes.items()}
+
+
+    def get_wait_percentiles(self):
+
+        """
+            It returns the percentiles of the recent wait times of all the classes.
+        """
+
+        with self.not_empty:
+            return wait_percentiles([wait for class_queue in self.classes.values()
+                                     for wait in class_queue.recent_waits])
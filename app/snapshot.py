@@ -0,0 +1,135 @@
+"""
+    This module keeps a columnar binary snapshot of the useful columns of the csv file,
+    so that the next starts memory-map it instead of parsing the csv again.
+
+    Every column is saved as a .npy file: the string columns as categorical codes
+    (with their categories in the manifest) and the values as floats.
+    The DataFrame read from a snapshot keeps the memory-mapped float columns and
+    categorical codes, so its pages are read (and shared between the processes)
+    on demand. The string columns of the default (not compact) mode are decoded
+    back to strings, and these are in memory.
+    The manifest also keeps a fingerprint of the csv file, and the snapshot is
+    used only while the csv is unchanged.
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+SNAPSHOT_VERSION = 1
+
+
+def fingerprint(csv_path):
+
+    """
+        It returns the SHA-256 digest of the csv file.
+    """
+
+    digest = hashlib.sha256()
+
+    with open(csv_path, 'rb') as csv_file:
+        for block in iter(lambda: csv_file.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def snapshot_directory(snapshot_dir, csv_path, mode):
+
+    """
+        It returns the directory of the snapshot of a csv file loaded in the given mode.
+    """
+
+    csv_name = os.path.splitext(os.path.basename(csv_path))[0]
+
+    return os.path.join(snapshot_dir, f"{csv_name}.{mode}")
+
+
+def write_snapshot(directory, df, csv_fingerprint):
+
+    """
+        It saves every column of the DataFrame and then the manifest, which is
+        renamed into place last, so that a snapshot is never read half-written.
+    """
+
+    os.makedirs(directory, exist_ok = True)
+    columns = {}
+
+    for column in df.columns:
+        values = df[column]
+
+        if values.dtype.kind == 'f':
+            np.save(os.path.join(directory, f"{column}.npy"), values.to_numpy())
+            columns[column] = {"dtype": str(values.dtype)}
+            continue
+
+        categorical = values if isinstance(values.dtype, pd.CategoricalDtype) \
+            else values.astype('category')
+        categories = categorical.cat.categories
+
+        np.save(os.path.join(directory, f"{column}.npy"), categorical.cat.codes.to_numpy())
+        columns[column] = {"dtype": str(values.dtype), "categories": categories.tolist()}
+
+    manifest = {
+        "version": SNAPSHOT_VERSION,
+        "fingerprint": csv_fingerprint,
+        "rows": len(df),
+        "columns": columns,
+    }
+
+    manifest_path = os.path.join(directory, 'manifest.json')
+
+    with open(manifest_path + '.tmp', 'w', encoding = 'utf-8') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def read_snapshot(directory, csv_fingerprint):
+
+    """
+        It returns the DataFrame saved in the snapshot, memory-mapping its columns,
+        or None if there is no snapshot of this version of the csv file.
+    """
+
+    manifest_path = os.path.join(directory, 'manifest.json')
+
+    try:
+        with open(manifest_path, 'r', encoding = 'utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get("version") != SNAPSHOT_VERSION or \
+       manifest.get("fingerprint") != csv_fingerprint:
+        return None
+
+    columns = {}
+
+    try:
+        for column, description in manifest["columns"].items():
+            #  a plain array view of the mapping, pandas handles it like any other array
+            values = np.load(os.path.join(directory, f"{column}.npy"),
+                             mmap_mode = 'r').view(np.ndarray)
+
+            if len(values) != manifest["rows"]:
+                return None
+
+            if "categories" not in description:
+                columns[column] = pd.Series(values, copy = False)
+                continue
+
+            #  the codes were written by write_snapshot, and validating them would copy them
+            categorical = pd.Series(pd.Categorical.from_codes(
+                values, dtype = pd.CategoricalDtype(description["categories"]), validate = False),
+                copy = False)
+            if description["dtype"] != 'category':
+                categorical = categorical.astype(description["dtype"])
+
+            columns[column] = categorical
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return pd.DataFrame(columns, copy = False)
@@ -2,13 +2,121 @@
     This module handles the synchronization.
 """
 
-from queue import Queue, Empty
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty
 from threading import Thread
+import multiprocessing
 import threading
+import time
 import os
 import json
+from .data_ingestor import DataIngestor
+from .result_cache import ResultCache, MISSING
+from .result_store import create_result_store
+from .job_registry import JobRegistry
+from .scheduler import FairScheduler, DEFAULT_COST
+from .admission import AdmissionControl
+from .metrics import Metrics
+from .materializer import Materializer
+from .webserver_log import logger
 
-class ThreadPool:
+#  the dataset of the worker processes of the process backend, inherited
+#  from the webserver process when they are forked (copy-on-write)
+WORKER_DATA_INGESTOR = None
+
+
+def run_encoded(data_ingestor, function, args):
+
+    """
+        It calls a data ingestor function and returns its JSON-encoded result,
+        with the time (in seconds) spent encoding it.
+        A batch returns the list of the encoded results of its queries.
+    """
+
+    result = function(data_ingestor, *args)
+    start = time.perf_counter()
+
+    if function is DataIngestor.get_batch:
+        encoded = [json.dumps(query_result).encode() for query_result in result]
+    else:
+        encoded = json.dumps(result).encode()
+
+    return encoded, time.perf_counter() - start
+
+
+def run_in_worker(function, args):
+
+    """
+        It is executed by a worker process, on the dataset it inherited.
+    """
+
+    return run_encoded(WORKER_DATA_INGESTOR, function, args)
+
+
+def coalescing_key(task_type, args, data_ingestor, dataset_version):
+
+    """
+        It returns the key of the identical tasks, which can be computed only once.
+        The version of the dataset changes when rows are appended to it in place,
+        so that a task submitted afterwards is not attached to one submitted before.
+    """
+
+    return (task_type, json.dumps(args), data_ingestor, dataset_version)
+
+
+class TaskCosts:
+
+    """
+        It keeps an exponential moving average of the execution time
+        of every task type.
+    """
+
+    def __init__(self, weight = 0.2):
+
+        """
+            It initializes the averages, the weight being the one of the last measurement.
+        """
+
+        self.weight = weight
+        self.costs = {}
+        self.lock = threading.Lock()
+
+
+    def record(self, task_type, seconds):
+
+        """
+            It adds the execution time of a task to the average of its type.
+        """
+
+        with self.lock:
+            cost = self.costs.get(task_type)
+            if cost is None:
+                self.costs[task_type] = seconds
+            else:
+                self.costs[task_type] = cost + self.weight * (seconds - cost)
+
+
+    def get(self, task_type):
+
+        """
+            It returns the average execution time of a task type, in seconds,
+            or None if no task of this type has been executed yet.
+        """
+
+        return self.costs.get(task_type)
+
+
+    def get_max(self):
+
+        """
+            It returns the highest average execution time, 0 if there is none yet.
+        """
+
+        with self.lock:
+            return max(self.costs.values(), default = 0.0)
+
+
+class ThreadPool:   # pylint: disable=too-many-instance-attributes
 
     """
         It implements a ThreadPool of TaskRunners.
@@ -20,56 +128,430 @@ class ThreadPool:
     def __init__(self, data_ingestor):
 
         """
-            It initializes a Threadpool with the env var TP_NUM_THREADS
+            It initializes a Threadpool with the env var TP_NUM_OF_THREADS
             if it is defined, otherwise using the number of logical CPUs available.
 
-            It uses a queue for tasks, an Event variable which should stop the 
-            webserver when it is set, a list for task runners, a dict in which
-            to keep the results and the data extracted from csv.
+            With TP_BACKEND=process, the tasks are computed by as many worker processes,
+            forked after the dataset is loaded so that they share it instead of reading
+            the csv again. The task runners only wait for them and update the job status.
+
+            It uses a fair scheduler as the queue for tasks, an Event variable which
+            should stop the webserver when it is set, a list for task runners, a job registry
+            which allocates the job ids and keeps their status and the data
+            extracted from csv.
+            It uses a dictonary to link task type and the function of the
+            data ingestor that has to be executed.
+
+            The results of the queries are cached, the cache being bounded by
+            TP_CACHE_MAX_ENTRIES entries and TP_CACHE_MAX_BYTES bytes.
+            The execution time of every task type is measured, in order to
+            know which tasks are cheap enough to be executed inline.
+            The results are kept in the store selected by TP_RESULT_STORE
+            ('file' by default, 'memory' or 'segment').
+            Unless TP_COALESCE=0, a job identical to a pending or processing one is
+            attached to it instead of being computed again.
+            At most TP_MAX_QUEUE_DEPTH tasks may wait (0 for no limit) and every client
+            may submit TP_CLIENT_RATE jobs per second (0 for no limit), in bursts of at
+            most TP_CLIENT_BURST jobs.
+            The time spent by the tasks in the queue, computing, encoding and writing their
+            results is recorded in histograms per task type, with the busy time of every
+            task runner.
+            With TP_MATERIALIZE=1, the results of all the possible queries are computed
+            in the background after the start and kept, so that a job is completed when
+            it is submitted. They are saved in TP_MATERIALIZE_DIR ('snapshot' by default,
+            empty to disable it) for the next start.
         """
 
         self.num_threads = os.getenv("TP_NUM_OF_THREADS")
         if self.num_threads is None:
             self.num_threads = os.cpu_count()
+        self.num_threads = int(self.num_threads)
 
-        self.tasks_queue = Queue()
+        self.task_costs = TaskCosts()
+        self.tasks_queue = FairScheduler(self.task_costs)
+        self.admission = AdmissionControl(int(os.getenv("TP_MAX_QUEUE_DEPTH", "50000")),
+                                          float(os.getenv("TP_CLIENT_RATE", "0")),
+                                          int(os.getenv("TP_CLIENT_BURST", "100")))
         self.graceful_shutdown = threading.Event()
         self.task_runners = []
-        self.job_results = {}
+        self.job_registry = JobRegistry()
+        self.coalescing = os.getenv("TP_COALESCE", "1") == "1"
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.dataset_version = 0
+        self.coalesced_jobs = 0
+        self.metrics = Metrics()
         self.data_ingestor = data_ingestor
+        self.result_cache = ResultCache(int(os.getenv("TP_CACHE_MAX_ENTRIES", "1024")),
+                                        int(os.getenv("TP_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
+        self.result_store = create_result_store(os.getenv("TP_RESULT_STORE", "file"))
+
+        self.tasks_dict = {
+            "get_states_mean" : DataIngestor.get_states_mean,
+            "get_state_mean" : DataIngestor.get_state_mean,
+            "get_best5" : DataIngestor.get_best5,
+            "get_worst5" : DataIngestor.get_worst5,
+            "get_global_mean" : DataIngestor.get_global_mean,
+            "get_diff_from_mean" : DataIngestor.get_diff_from_mean,
+            "get_state_diff_from_mean" : DataIngestor.get_state_diff_from_mean,
+            "get_mean_by_category" : DataIngestor.get_mean_by_category,
+            "get_state_mean_by_category" : DataIngestor.get_state_mean_by_category
+        }
+
+        self.process_pool = None
+        if os.getenv("TP_BACKEND", "thread") == "process":
+            self.process_pool = self.start_process_pool()
 
         for i in range(self.num_threads):
             task_runner = TaskRunner(i, self)
             task_runner.start()
             self.task_runners.append(task_runner)
 
+        self.materializer = None
+        self.materializer_threads = []
+        if os.getenv("TP_MATERIALIZE", "0") == "1":
+            self.materializer = Materializer(self, self.num_threads,
+                                             os.getenv("TP_MATERIALIZE_DIR", "snapshot") or None)
+            self.refresh_materialized()
+
 
-    def submit(self, task_type, args, job_id):
+    def start_process_pool(self):
 
         """
-            It adds a task in the queue, udpating its arguments in the 
-            job_results too.
+            It forks the worker processes of the process backend, all of them at once.
+            At startup, they are forked before the task runners are started. On a restart
+            (see restart_process_pool), the webserver threads are running: a worker only
+            inherits the forking thread, and the locks held by the other threads stay
+            held in it. This is safe only because the workers just run the query methods
+            of the inherited DataIngestor, which take no lock and do not log.
+            Spawned (or forkserver) workers would not inherit any lock, but they would
+            import the app package again, which loads the dataset and starts a webserver.
         """
 
-        self.job_results[job_id] = {
-            "status": "pending",
-            "task_type": task_type,
-            "worker": None,
-        }
+        global WORKER_DATA_INGESTOR   # pylint: disable=global-statement
+        WORKER_DATA_INGESTOR = self.data_ingestor
+
+        process_pool = ProcessPoolExecutor(max_workers = self.num_threads,
+                                           mp_context = multiprocessing.get_context('fork'))
+        process_pool.submit(int).result()
+
+        #  the dataset of the workers, kept with the pool so that both are read at once
+        process_pool.data_ingestor = self.data_ingestor
+
+        return process_pool
+
+
+    def compute(self, task_type, function, args, data_ingestor = None):
+
+        """
+            It calls a data ingestor function on the current dataset (or on the given
+            one) and returns its JSON-encoded result, computing it in a worker process
+            with the process backend, if the workers were forked with that dataset.
+            It records the computation time (including the round trip to the worker
+            process) and the encoding time of the task type.
+        """
+
+        start = time.perf_counter()
+
+        if data_ingestor is None:
+            data_ingestor = self.data_ingestor
+
+        process_pool = self.process_pool
+        future = None
+
+        if process_pool is not None and process_pool.data_ingestor is data_ingestor:
+            try:
+                future = process_pool.submit(run_in_worker, function, args)
+            except RuntimeError:
+                #  the worker processes have just been replaced, because of a new dataset
+                future = None
+
+        if future is None:
+            result, serialize_seconds = run_encoded(data_ingestor, function, args)
+        else:
+            result, serialize_seconds = future.result()
+
+        self.metrics.record("compute", task_type,
+                            time.perf_counter() - start - serialize_seconds)
+        self.metrics.record("serialize", task_type, serialize_seconds)
+
+        return result
+
+
+    def refresh_materialized(self, changed_questions = None):
+
+        """
+            It drops the materialized results of the changed questions (all of them
+            if they are not known) and computes them again on the current dataset,
+            in the background.
+        """
+
+        if self.materializer is None:
+            return
+
+        data_ingestor = self.data_ingestor
+        generation = self.materializer.invalidate(data_ingestor, changed_questions)
+
+        refresh_thread = Thread(target = self.materializer.refresh,
+                                args = (data_ingestor, changed_questions, generation),
+                                daemon = True)
+        refresh_thread.start()
+
+        self.materializer_threads = [thread for thread in self.materializer_threads
+                                     if thread.is_alive()] + [refresh_thread]
+
+
+    def get_materialized(self, task_type, args, data_ingestor):
+
+        """
+            It returns the materialized result of a task on the given dataset,
+            or MISSING if there is none.
+        """
+
+        if self.materializer is None:
+            return MISSING
 
-        self.tasks_queue.put((task_type, args, job_id))
+        return self.materializer.get((task_type, tuple(args)), data_ingestor)
+
+
+    def submit(self, task_type, args, priority = None, client = None):
+
+        """
+            It registers a new pending job and adds its task in the queue,
+            returning the job_id.
+            The task keeps the current dataset, so that it is computed on it
+            even if a new dataset is set in the meantime.
+            The task is scheduled in the given priority class (by default, the
+            class of its type), fairly with the tasks of the other clients.
+
+            If an identical task (same type, arguments and dataset) is already pending
+            or processing, the job is attached to it and completed together with it.
+            If its result is materialized, the job is completed at once.
+        """
+
+        data_ingestor = self.data_ingestor
+        job_id = self.job_registry.allocate(task_type)
+        self.metrics.record_submit(task_type)
+
+        result = self.get_materialized(task_type, args, data_ingestor)
+        if result is not MISSING:
+            self.result_store.put(job_id, result)
+            self.job_registry.set_status(job_id, "completed", -1)
+            return job_id
+
+        dataset_version = self.dataset_version
+
+        if self.coalescing:
+            key = coalescing_key(task_type, args, data_ingestor, dataset_version)
+
+            with self.in_flight_lock:
+                if key in self.in_flight:
+                    self.in_flight[key].append(job_id)
+                    self.coalesced_jobs += 1
+                    return job_id
+
+                self.in_flight[key] = [job_id]
+
+        self.tasks_queue.put((task_type, args, job_id, data_ingestor, dataset_version,
+                              time.monotonic()), task_type, priority, client)
+
+        return job_id
+
+
+    def check_queue_depth(self):
+
+        """
+            It returns None if one more task may be queued, otherwise an estimation
+            of the seconds needed to drain the queue, as a Retry-After hint.
+        """
+
+        queue_depth = self.tasks_queue.qsize()
+        drain_seconds = queue_depth * max(DEFAULT_COST, self.task_costs.get_max()) / \
+            max(self.num_threads, 1)
+
+        return self.admission.check_depth(queue_depth, drain_seconds)
+
+
+    def finish_jobs(self, task_type, args, job_id, data_ingestor, dataset_version):
+
+        """
+            It returns the ids of the jobs completed by a task: its own job and the
+            jobs attached to it, which cannot be attached anymore after this call.
+        """
+
+        if not self.coalescing:
+            return [job_id]
+
+        with self.in_flight_lock:
+            return self.in_flight.pop(coalescing_key(task_type, args, data_ingestor,
+                                                     dataset_version))
+
+
+    def execute(self, task_type, args, budget = None, data_ingestor = None):
+
+        """
+            It returns the cached result of a task if there is one, otherwise
+            it computes it on the current dataset and caches it.
+            The result is returned encoded as JSON bytes.
+
+            If a time budget (in seconds) is given, the task is computed only if its
+            average execution time fits in the budget, otherwise MISSING is returned.
+
+            A task submitted on a dataset which has been replaced since then
+            is computed on that dataset, without the cache.
+            A materialized result is returned before looking into the cache.
+            The current dataset is read once, so that a task is computed entirely on
+            the same dataset even if a new one is set in the meantime.
+        """
+
+        #  read before the dataset, so that a result computed on a dataset which is
+        #  replaced in the meantime is not cached (the cache is invalidated after the swap)
+        generation = self.result_cache.generation
+        current_data_ingestor = self.data_ingestor
+
+        if data_ingestor is not None and data_ingestor is not current_data_ingestor:
+            if task_type == "batch":
+                return b'[' + b', '.join(self.compute(task_type, DataIngestor.get_batch, args,
+                                                      data_ingestor)) + b']'
+
+            return self.compute(task_type, self.tasks_dict[task_type], args, data_ingestor)
+
+        if task_type == "batch":
+            #  a batch is never executed inline
+            return MISSING if budget is not None else self.execute_batch(
+                *args, data_ingestor = current_data_ingestor, generation = generation)
+
+        key = (task_type, tuple(args))
+
+        result = self.get_materialized(task_type, args, current_data_ingestor)
+        if result is MISSING:
+            result = self.result_cache.get(key)
+        if result is not MISSING:
+            return result
+
+        if budget is not None:
+            cost = self.task_costs.get(task_type)
+            if cost is None or cost > budget:
+                return MISSING
+
+        start = time.perf_counter()
+        result = self.compute(task_type, self.tasks_dict[task_type], args, current_data_ingestor)
+        self.task_costs.record(task_type, time.perf_counter() - start)
+
+        self.result_cache.put(key, result, generation)
+
+        return result
+
+
+    def execute_batch(self, queries, data_ingestor = None, generation = None):
+
+        """
+            It executes a list of [task_type, args] queries on the given dataset
+            (the current one by default), returning a JSON list with their results in order.
+            The cached results are reused, the identical queries are computed once
+            and the other ones are planned together by the data ingestor.
+            The results are cached only if the cache is still at the given generation.
+        """
+
+        if generation is None:
+            generation = self.result_cache.generation
+        if data_ingestor is None:
+            data_ingestor = self.data_ingestor
+
+        keys = [(task_type, tuple(args)) for task_type, args in queries]
+        results = {}
+
+        for key in dict.fromkeys(keys):
+            result = self.get_materialized(*key, data_ingestor)
+            if result is MISSING:
+                result = self.result_cache.get(key)
+            if result is not MISSING:
+                results[key] = result
+
+        missing_keys = [key for key in dict.fromkeys(keys) if key not in results]
+
+        if missing_keys:
+            start = time.perf_counter()
+            computed = self.compute("batch", DataIngestor.get_batch,
+                                    [[(task_type, list(args)) for task_type, args in missing_keys]],
+                                    data_ingestor)
+            self.task_costs.record("batch", time.perf_counter() - start)
+
+            for key, result in zip(missing_keys, computed):
+                results[key] = result
+                self.result_cache.put(key, result, generation)
+
+        return b'[' + b', '.join(results[key] for key in keys) + b']'
+
+
+    def set_data_ingestor(self, data_ingestor, changed_questions = None):
+
+        """
+            It replaces the dataset used by the next jobs and drops the cached
+            results computed on the previous one, or only the results of the
+            changed questions if they are known.
+        """
+
+        self.data_ingestor = data_ingestor
+        self.result_cache.invalidate(changed_questions)
+        self.restart_process_pool()
+        self.refresh_materialized(changed_questions)
+
+
+    def append_rows(self, rows):
+
+        """
+            It adds a batch of rows to the current dataset (see DataIngestor.append_rows)
+            and drops the cached results of the questions which received rows.
+            The jobs submitted from now on are not attached to the tasks submitted before.
+            It returns the set of these questions.
+        """
+
+        changed_questions = self.data_ingestor.append_rows(rows)
+
+        with self.in_flight_lock:
+            self.dataset_version += 1
+
+        self.result_cache.invalidate(changed_questions)
+        self.restart_process_pool()
+        self.refresh_materialized(changed_questions)
+
+        return changed_questions
+
+
+    def restart_process_pool(self):
+
+        """
+            With the process backend, it forks new worker processes with the current
+            dataset, the old ones finishing the tasks they already received.
+            Unlike at startup, the other threads are running while forking (see
+            start_process_pool for why the workers do not depend on their locks).
+        """
+
+        if self.process_pool is not None:
+            old_process_pool = self.process_pool
+            self.process_pool = self.start_process_pool()
+            old_process_pool.shutdown(wait = False)
 
 
     def shutdown(self):
 
         """
-            It stops all the task runners.
+            It stops all the task runners and the refreshes of the materialized results.
         """
 
         self.graceful_shutdown.set()
         for task_runner in self.task_runners:
             task_runner.join()
 
+        if self.materializer is not None:
+            self.materializer.stop()
+            for refresh_thread in self.materializer_threads:
+                refresh_thread.join()
+
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+
 
     def get_job_status(self, job_id):
 
@@ -77,10 +559,7 @@ class ThreadPool:
             It gets job_status for a provided job_id.
         """
 
-        if job_id in self.job_results:
-            return self.job_results[job_id]
-
-        return None
+        return self.job_registry.get(job_id)
 
 
 class TaskRunner(Thread):
@@ -88,35 +567,23 @@ class TaskRunner(Thread):
     """
         It handles a job.
         It constantly updates its status.
-        It writes the result to a specific file.
+        It saves the result to the result store.
     """
 
     def __init__(self, index, threadpool):
 
         """
             It initializes each task runner.
-            It uses a dictonary to link task type and the function that
-            has to be executed by the task runner.
+            The tasks are executed through the threadpool, which links every
+            task type to the function of the data ingestor.
         """
 
         super().__init__()
         self.index = index
+        self.threadpool = threadpool
         self.tasks_queue = threadpool.tasks_queue
         self.graceful_shutdown = threadpool.graceful_shutdown
-        self.data_ingestor = threadpool.data_ingestor
-        self.job_results = threadpool.job_results
-
-        self.tasks_dict = {
-            "get_states_mean" : self.data_ingestor.get_states_mean,
-            "get_state_mean" : self.data_ingestor.get_state_mean,
-            "get_best5" : self.data_ingestor.get_best5,
-            "get_worst5" : self.data_ingestor.get_worst5,
-            "get_global_mean" : self.data_ingestor.get_global_mean,
-            "get_diff_from_mean" : self.data_ingestor.get_diff_from_mean,
-            "get_state_diff_from_mean" : self.data_ingestor.get_state_diff_from_mean,
-            "get_mean_by_category" : self.data_ingestor.get_mean_by_category,
-            "get_state_mean_by_category" : self.data_ingestor.get_state_mean_by_category
-        }
+        self.job_registry = threadpool.job_registry
 
 
     def run(self):
@@ -124,8 +591,11 @@ class TaskRunner(Thread):
         """
             It gets pending job
             It updates job status from 'pending' to processing'
-            It executes the job and save the result to disk
-            It updates job status from 'processing' to 'completed'
+            It executes the job and saves the result to the result store,
+            for the job and for the identical jobs attached to it
+            It updates their status to 'completed', or to 'failed' if the
+            execution raised an error
+            It records the queue wait of the task and its own busy time
             It repeats until graceful_shutdown
         """
 
@@ -134,35 +604,44 @@ class TaskRunner(Thread):
                 return
 
             try:
-                task_type, args, job_id = self.tasks_queue.get(timeout = 0.5)
+                task_type, args, job_id, data_ingestor, dataset_version, submit_time = \
+                    self.tasks_queue.get(timeout = 0.5)
             except Empty:
                 continue
 
-            self.job_results[job_id] = {
-                "status": "processing",
-                "task_type": task_type,
-                "worker": self.index,
-            }
+            start = time.monotonic()
+            self.threadpool.metrics.record("queue_wait", task_type, start - submit_time)
+            self.job_registry.set_status(job_id, "processing", self.index)
+
+            result = None
 
-            result = self.tasks_dict[task_type](*args)
+            try:
+                result = self.threadpool.execute(task_type, args, data_ingestor = data_ingestor)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Job %d (%s) failed", job_id, task_type)
+            finally:
+                #  the attached jobs are released even if the task failed
+                finished_job_ids = self.threadpool.finish_jobs(task_type, args, job_id,
+                                                               data_ingestor, dataset_version)
 
-            self.save_result(job_id, result)
+            for finished_job_id in finished_job_ids:
+                if result is None:
+                    self.job_registry.set_status(finished_job_id, "failed", self.index)
+                    continue
 
-            self.job_results[job_id] = {
-                "status": "completed",
-                "task_type": task_type,
-                "worker": self.index,
-            }
+                self.save_result(finished_job_id, result, task_type)
+                self.job_registry.set_status(finished_job_id, "completed", self.index)
 
+            self.threadpool.metrics.record_busy(self.index, time.monotonic() - start)
 
-    def save_result(self, job_id, result):
+
+    def save_result(self, job_id, result, task_type):
 
         """
-            It saves the result to 'results/job_{job_id}.json' file
+            It saves the JSON-encoded result to the result store,
+            recording the write time of the task type.
         """
 
-        os.makedirs('results', exist_ok = True)
-        filename = f"results/job_{job_id}.json"
-
-        with open(filename, 'w', encoding = 'utf-8') as result_file:
-            json.dump(result, result_file) 
+        start = time.perf_counter()
+        self.threadpool.result_store.put(job_id, result)
+        self.threadpool.metrics.record("result_write", task_type, time.perf_counter() - start)
@@ -1,37 +1,218 @@
 """
     Webserver logging configuration file.
-    
+
     It helps for debugging.
     It implements a rotating file handler for the 'webserver.log' file.
     It configures proper UTC timestamp formatting.
+
+    It is configured from the environment:
+        - LOG_LEVEL: the level of the logger (DEBUG by default)
+        - LOG_ASYNC=1: the records are put in a bounded queue (LOG_QUEUE_SIZE) and written
+          by a background thread in batches of at most LOG_BATCH_SIZE records; when the
+          queue is full, the records are dropped and counted
+        - LOG_SAMPLE_EVERY: only one in every LOG_SAMPLE_EVERY records logged with
+          extra = {"sampled": True} (the high-frequency messages) is kept
 """
 
+import atexit
+import itertools
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler
+import os
+import queue
+import threading
 import time
 
 # Configure logger
 logger = logging.getLogger('webserver')
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.getenv("LOG_LEVEL", "DEBUG").upper())
+
+#  counters of the records that were not written
+log_counters = {"dropped": 0, "sampled_out": 0}
+log_counters_lock = threading.Lock()
+
+
+def count_record(counter):
+
+    """
+        It increases one of the counters of the records that were not written.
+    """
+
+    with log_counters_lock:
+        log_counters[counter] += 1
+
+
+def format_time_utc(record, _datefmt = None):
+
+    """
+        Get the UTC time at which the record was created (not the time it is
+        formatted at, which is later for the records written in batches)
+    """
+
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(record.created))
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+
+    """
+        It is a rotating file handler which can also write a batch of records
+        with a single write, flush and rollover check.
+    """
+
+    def emit_batch(self, records):
+
+        """
+            It formats the records and writes them at once, rolling the file
+            over first if they do not fit in it.
+        """
+
+        text = "".join(self.format(record) + self.terminator for record in records)
+
+        with self.lock:
+            try:
+                if 0 < self.maxBytes <= self.stream.tell() + len(text):
+                    self.doRollover()
+
+                self.stream.write(text)
+                self.stream.flush()
+            except OSError:
+                self.handleError(records[0])
+
+
+class DroppingQueueHandler(QueueHandler):
+
+    """
+        It puts the records in a bounded queue without ever blocking,
+        counting the records dropped when the queue is full.
+    """
+
+    def enqueue(self, record):
+
+        """
+            It puts a record in the queue, or drops it if the queue is full.
+        """
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            count_record("dropped")
+
+
+class BatchLogWriter(threading.Thread):
+
+    """
+        It takes the records from the queue and writes them in batches.
+    """
+
+    def __init__(self, records, file_handler, batch_size):
+
+        """
+            It initializes the writer, which runs as a daemon thread.
+        """
+
+        super().__init__(name = 'log-writer', daemon = True)
+        self.records = records
+        self.file_handler = file_handler
+        self.batch_size = batch_size
+
+
+    def run(self):
+
+        """
+            It waits for a record, takes the records already queued after it
+            and writes them together, until it gets None.
+        """
+
+        while True:
+            batch = [self.records.get()]
+
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+
+            if batch:
+                self.file_handler.emit_batch(batch)
+
+            if stop:
+                return
+
+
+    def stop(self):
+
+        """
+            It writes the remaining records and stops the writer.
+        """
+
+        self.records.put(None)
+        self.join()
 
-def format_time_utc(*_args):
+
+def sample_records(sample_every):
 
     """
-        Get current UTC time
+        It returns a filter which keeps one in every 'sample_every' sampled records.
     """
 
-    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+    sampled_records = itertools.count()
+
+    def keep_record(record):
+        if not getattr(record, "sampled", False):
+            return True
+
+        if next(sampled_records) % sample_every == 0:
+            return True
+
+        count_record("sampled_out")
+        return False
+
+    return keep_record
+
+
+def get_log_stats():
+
+    """
+        It returns the counters of the records that were not written and
+        the number of records waiting in the queue.
+    """
+
+    with log_counters_lock:
+        log_stats = dict(log_counters)
+
+    log_stats["queued"] = log_queue.qsize() if log_queue is not None else 0
+
+    return log_stats
+
 
 # Set a single formatter with UTC time
 formatter = logging.Formatter('[%(asctime)s] [%(levelname)s] %(message)s')
 formatter.formatTime = format_time_utc
 
 # Create rotating file handler
-handler = RotatingFileHandler('webserver.log', maxBytes = 10 * 1024 * 1024,
-                               backupCount = 5, encoding = 'utf-8')
+handler = BatchRotatingFileHandler('webserver.log', maxBytes = 10 * 1024 * 1024,
+                                   backupCount = 5, encoding = 'utf-8')
 
 # Apply formatter to the handler
 handler.setFormatter(formatter)
 
-# Add handler to logger     
-logger.addHandler(handler)
+log_queue = None
+
+if os.getenv("LOG_ASYNC") == "1":
+    log_queue = queue.Queue(int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+    log_writer = BatchLogWriter(log_queue, handler, int(os.getenv("LOG_BATCH_SIZE", "256")))
+    log_writer.start()
+    atexit.register(log_writer.stop)
+
+    # Add the queue handler to logger
+    logger.addHandler(DroppingQueueHandler(log_queue))
+else:
+    # Add handler to logger
+    logger.addHandler(handler)
+
+if int(os.getenv("LOG_SAMPLE_EVERY", "1")) > 1:
+    logger.addFilter(sample_records(int(os.getenv("LOG_SAMPLE_EVERY"))))
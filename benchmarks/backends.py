@@ -0,0 +1,98 @@
+"""
+    Compares the thread and the process backends of the ThreadPool.
+
+    For every backend and number of workers, it submits the same jobs (all the
+    task types, for every question and some states) with the results cache and
+    the coalescing of identical jobs disabled and reports the throughput.
+
+    Usage (from the repository root):
+        python -m benchmarks.backends [--workers 1 2 4 8] [--jobs N]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import time
+
+from app import webserver
+from app.task_runner import ThreadPool
+
+STATE_TASKS = ["get_state_mean", "get_state_diff_from_mean", "get_state_mean_by_category"]
+QUESTION_TASKS = ["get_states_mean", "get_best5", "get_worst5", "get_global_mean",
+                  "get_diff_from_mean", "get_mean_by_category"]
+
+
+def build_jobs(data_ingestor, num_jobs):
+
+    """
+        It builds 'num_jobs' (task_type, args) jobs, cycling through all the task types,
+        the questions and the states.
+    """
+
+    questions = sorted(data_ingestor.question_index)
+    states = sorted(data_ingestor.df['LocationDesc'].dropna().unique())
+
+    all_jobs = [(task_type, [question]) for question in questions for task_type in QUESTION_TASKS]
+    all_jobs += [(task_type, [state, question]) for question in questions
+                 for state in states[:5] for task_type in STATE_TASKS]
+
+    return list(itertools.islice(itertools.cycle(all_jobs), num_jobs))
+
+
+def run_backend(backend, num_workers, jobs):
+
+    """
+        It starts a ThreadPool with the given backend, submits all the jobs and
+        waits for them, returning the throughput in jobs per second.
+    """
+
+    os.environ["TP_BACKEND"] = backend
+    os.environ["TP_NUM_OF_THREADS"] = str(num_workers)
+    os.environ["TP_CACHE_MAX_ENTRIES"] = "0"
+    os.environ["TP_COALESCE"] = "0"
+    os.environ["TP_RESULT_STORE"] = "memory"
+
+    threadpool = ThreadPool(webserver.data_ingestor)
+
+    start = time.perf_counter()
+    job_ids = [threadpool.submit(task_type, args) for task_type, args in jobs]
+
+    for job_id in job_ids:
+        while threadpool.get_job_status(job_id)["status"] != "completed":
+            time.sleep(0.001)
+    duration = time.perf_counter() - start
+
+    threadpool.shutdown()
+
+    return len(jobs) / duration
+
+
+def main():
+
+    """
+        It runs every backend with every number of workers and prints the results as JSON.
+    """
+
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--workers', type = int, nargs = '+', default = [1, 2, 4, os.cpu_count()])
+    parser.add_argument('--jobs', type = int, default = 2000)
+    args = parser.parse_args()
+
+    webserver.tasks_runner.shutdown()
+    jobs = build_jobs(webserver.data_ingestor, args.jobs)
+
+    results = []
+    for backend in ["thread", "process"]:
+        for num_workers in args.workers:
+            results.append({
+                "backend": backend,
+                "workers": num_workers,
+                "jobs_per_second": run_backend(backend, num_workers, jobs),
+            })
+
+    print(json.dumps(results, indent = 4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+    Compares the default and the compact (categorical) ingestion modes of the DataIngestor.
+
+    For every mode, it reports the resident memory added by loading the dataset,
+    the memory of the DataFrame and the average latency of a scan filter and of the queries.
+    Each mode is measured in a separate process, so that the resident memory is not shared.
+
+    Usage (from the repository root):
+        python -m benchmarks.compact_ingestion [--csv PATH] [--repeat N]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+CSV_PATH = './nutrition_activity_obesity_usa_subset.csv'
+
+MODES = {
+    "default": {},
+    "compact_float64": {"compact": True, "value_dtype": "float64"},
+    "compact_float32": {"compact": True, "value_dtype": "float32"},
+}
+
+
+def resident_bytes():
+
+    """
+        It returns the resident memory of the current process (Linux only).
+    """
+
+    with open('/proc/self/statm', 'r', encoding = 'utf-8') as statm:
+        resident_pages = int(statm.read().split()[1])
+
+    return resident_pages * 4096
+
+
+def average_latency(function, repeat):
+
+    """
+        It returns the average duration of a call, in microseconds.
+    """
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def measure_mode(csv_path, mode, repeat):
+
+    """
+        It loads the dataset in the given mode and measures it.
+    """
+
+    # pylint: disable=import-outside-toplevel
+    from app import webserver
+    from app.data_ingestor import DataIngestor
+
+    webserver.tasks_runner.shutdown()
+
+    rss_before = resident_bytes()
+    data_ingestor = DataIngestor(csv_path, **MODES[mode])
+    rss_after = resident_bytes()
+
+    df = data_ingestor.df
+    question = df['Question'].iloc[0]
+    state = df['LocationDesc'].iloc[0]
+
+    return {
+        "mode": mode,
+        "resident_bytes": rss_after - rss_before,
+        "dataframe_bytes": int(df.memory_usage(deep = True).sum()),
+        "index_report": data_ingestor.get_index_report(),
+        "latency_us": {
+            "question_scan": average_latency(lambda: df[df['Question'] == question], repeat),
+            "get_states_mean": average_latency(
+                lambda: data_ingestor.get_states_mean(question), repeat),
+            "get_state_mean": average_latency(
+                lambda: data_ingestor.get_state_mean(state, question), repeat),
+            "get_mean_by_category": average_latency(
+                lambda: data_ingestor.get_mean_by_category(question), repeat),
+        },
+    }
+
+
+def main():
+
+    """
+        It runs every mode in a child process and prints the reports as JSON.
+    """
+
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--csv', default = CSV_PATH)
+    parser.add_argument('--repeat', type = int, default = 200)
+    parser.add_argument('--mode', choices = MODES, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(measure_mode(args.csv, args.mode, args.repeat)))
+        return
+
+    reports = []
+    for mode in MODES:
+        child = subprocess.run([sys.executable, '-m', 'benchmarks.compact_ingestion',
+                                '--csv', args.csv, '--repeat', str(args.repeat), '--mode', mode],
+                               check = True, capture_output = True, text = True)
+        reports.append(json.loads(child.stdout.splitlines()[-1]))
+
+    print(json.dumps(reports, indent = 4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""
+    Times the nine query methods of the DataIngestor, in process, on every distinct
+    question (and every state, for the methods of a single state).
+
+    For every method, it reports the median and the best duration of a call over the
+    '--repeat' passes (each one going over the calls as many times as needed to last
+    MIN_PASS_SECONDS), and the memory allocated by a pass, traced with tracemalloc in
+    a separate pass: the number of allocated blocks still alive after it and the peak of
+    the traced memory, per call.
+
+    With '--save', the results are saved as the baseline. Otherwise, if there is a
+    baseline, the run is compared with it and fails (exit status 1) if the best
+    duration (the least disturbed by the other processes) or the peak memory of a
+    method grew by more than '--threshold'.
+
+    Usage (from the repository root):
+        python -m benchmarks.ingestor_benchmark [--csv PATH] [--repeat N]
+                                                [--baseline PATH] [--save] [--threshold 0.25]
+"""
+
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+from app import webserver
+from app.data_ingestor import DataIngestor
+
+QUESTION_METHODS = ["get_states_mean", "get_best5", "get_worst5", "get_global_mean",
+                    "get_diff_from_mean", "get_mean_by_category"]
+STATE_METHODS = ["get_state_mean", "get_state_diff_from_mean", "get_state_mean_by_category"]
+
+#  shortest duration (in seconds) of a timed pass over the calls of a method
+MIN_PASS_SECONDS = 0.05
+
+#  the measurements compared with the baseline
+COMPARED = ["best_us", "alloc_peak_bytes"]
+
+
+def build_calls(data_ingestor):
+
+    """
+        It returns the arguments of the calls of every method: every question,
+        and every (state, question) pair for the methods of a single state.
+    """
+
+    questions = sorted(data_ingestor.question_index)
+    states = sorted(data_ingestor.df['LocationDesc'].dropna().unique())
+
+    calls = {method: [(question,) for question in questions] for method in QUESTION_METHODS}
+    calls.update({method: [(state, question) for question in questions for state in states]
+                  for method in STATE_METHODS})
+
+    return calls
+
+
+def measure_method(data_ingestor, method, calls, repeat):
+
+    """
+        It times 'repeat' passes over the calls of a method, then traces
+        the memory allocated by one more pass.
+    """
+
+    function = getattr(data_ingestor, method)
+
+    def run_pass(rounds):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for args in calls:
+                function(*args)
+        return time.perf_counter() - start
+
+    #  the first pass warms up, and then every pass lasts at least MIN_PASS_SECONDS
+    rounds = max(1, math.ceil(MIN_PASS_SECONDS / max(run_pass(1), 1e-9)))
+    durations = [run_pass(rounds) / (rounds * len(calls)) * 1e6 for _ in range(repeat)]
+
+    tracemalloc.start()
+    blocks_before = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+
+    for args in calls:
+        function(*args)
+
+    blocks_after = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "calls": len(calls),
+        "median_us": statistics.median(durations),
+        "best_us": min(durations),
+        "alloc_retained_blocks": blocks_after - blocks_before,
+        "alloc_peak_bytes": peak_bytes,
+    }
+
+
+def compare(results, baseline, threshold):
+
+    """
+        It returns the measurements which grew by more than 'threshold'
+        (a fraction) since the baseline.
+    """
+
+    regressions = []
+
+    for method, measurements in results.items():
+        for measurement in COMPARED:
+            before = baseline.get(method, {}).get(measurement)
+            after = measurements[measurement]
+
+            if before and after > before * (1 + threshold):
+                regressions.append({"method": method, "measurement": measurement,
+                                    "baseline": before, "current": after,
+                                    "change": after / before - 1})
+
+    return regressions
+
+
+def main():
+
+    """
+        It measures every method, prints the results as JSON and saves them
+        as the baseline or compares them with it.
+    """
+
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--csv', default = './nutrition_activity_obesity_usa_subset.csv')
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--methods', nargs = '+', default = QUESTION_METHODS + STATE_METHODS)
+    parser.add_argument('--baseline', default = 'benchmarks/ingestor_baseline.json')
+    parser.add_argument('--save', action = 'store_true', help = 'save the results as the baseline')
+    parser.add_argument('--threshold', type = float, default = 0.25)
+    args = parser.parse_args()
+
+    webserver.tasks_runner.shutdown()
+
+    data_ingestor = DataIngestor(args.csv)
+    calls = build_calls(data_ingestor)
+
+    results = {method: measure_method(data_ingestor, method, calls[method], args.repeat)
+               for method in args.methods}
+    report = {"results": results}
+
+    if args.save:
+        with open(args.baseline, 'w', encoding = 'utf-8') as baseline_file:
+            json.dump(results, baseline_file, indent = 4)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding = 'utf-8') as baseline_file:
+            report["regressions"] = compare(results, json.load(baseline_file), args.threshold)
+
+    print(json.dumps(report, indent = 4))
+
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""
+    Replays the requests of the checker corpus (tests/*/input/in-*.json) against a
+    running webserver and reports the end-to-end latency (from the submission to the
+    final get_results response), the throughput and the error rate.
+
+    In the closed loop (the default), '--concurrency' clients each submit a request,
+    wait for its result and submit the next one. In the open loop, the requests are
+    sent at '--rate' requests per second whatever the response times are, the latency
+    being measured from the time a request was due, so that a server falling behind
+    shows up in the percentiles. The endpoints are picked at random with the weights
+    of '--mix' (all the endpoints of the corpus, equally, by default).
+
+    Usage (from the repository root, with the webserver running or '--start-server'):
+        python -m benchmarks.load_test [--url URL] [--mode closed|open] [--concurrency N]
+                                       [--rate R] [--duration S] [--mix best5=2,state_mean=1]
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+#  seconds a get_results request blocks waiting for its job
+POLL_WAIT_SECONDS = 10
+
+
+def load_corpus(tests_dir):
+
+    """
+        It returns the request bodies of the corpus, by endpoint.
+    """
+
+    corpus = {}
+
+    for path in sorted(glob.glob(os.path.join(tests_dir, '*', 'input', 'in-*.json'))):
+        endpoint = os.path.basename(os.path.dirname(os.path.dirname(path)))
+
+        with open(path, 'r', encoding = 'utf-8') as input_file:
+            corpus.setdefault(endpoint, []).append(json.load(input_file))
+
+    return corpus
+
+
+def parse_mix(mix, corpus):
+
+    """
+        It returns the (endpoints, weights) of a 'endpoint=weight,...' mix,
+        every endpoint of the corpus having a weight of 1 if the mix is empty.
+    """
+
+    if not mix:
+        return sorted(corpus), [1.0] * len(corpus)
+
+    weights = {}
+    for item in mix.split(','):
+        endpoint, _, weight = item.partition('=')
+        if endpoint not in corpus:
+            raise SystemExit(f"No requests for the endpoint '{endpoint}' in the corpus")
+        weights[endpoint] = float(weight or 1)
+
+    return list(weights), list(weights.values())
+
+
+def percentiles(latencies):
+
+    """
+        It returns the 50th, 95th and 99th percentiles (nearest rank), the mean
+        and the maximum of the latencies.
+    """
+
+    latencies = sorted(latencies)
+
+    if not latencies:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+
+    summary = {f"p{percentile}": latencies[min(len(latencies) - 1,
+                                               len(latencies) * percentile // 100)]
+               for percentile in (50, 95, 99)}
+    summary["mean"] = sum(latencies) / len(latencies)
+    summary["max"] = latencies[-1]
+
+    return summary
+
+
+class LoadTest:   # pylint: disable=too-many-instance-attributes
+
+    """
+        It sends the requests and collects the latency of every one of them,
+        by endpoint, and the errors.
+    """
+
+    def __init__(self, url, corpus, mix, seed):
+
+        """
+            It initializes the load test against the webserver at 'url'.
+        """
+
+        self.url = url.rstrip('/')
+        self.corpus = corpus
+        self.endpoints, self.weights = parse_mix(mix, corpus)
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.sessions = threading.local()
+        self.lock = threading.Lock()
+        self.latencies = {endpoint: [] for endpoint in self.endpoints}
+        self.errors = {}
+
+
+    def next_request(self):
+
+        """
+            It picks the endpoint and the body of the next request.
+        """
+
+        with self.random_lock:
+            endpoint = self.random.choices(self.endpoints, self.weights)[0]
+            return endpoint, self.random.choice(self.corpus[endpoint])
+
+
+    def run_request(self, endpoint, body):
+
+        """
+            It submits a request and waits for its result, returning None
+            or the reason of the failure.
+        """
+
+        session = getattr(self.sessions, "session", None)
+        if session is None:
+            session = self.sessions.session = requests.Session()
+
+        try:
+            response = session.post(f"{self.url}/api/{endpoint}", json = body, timeout = 30)
+            if response.status_code != 200:
+                return f"submit HTTP {response.status_code}"
+
+            job_id = response.json().get("job_id")
+            if job_id is None:
+                return "submit rejected"
+
+            while True:
+                response = session.get(f"{self.url}/api/get_results/{job_id}",
+                                       params = {"wait": POLL_WAIT_SECONDS},
+                                       timeout = POLL_WAIT_SECONDS + 30)
+                if response.status_code != 200:
+                    return f"get_results HTTP {response.status_code}"
+
+                status = response.json().get("status")
+                if status == "done":
+                    return None
+                if status != "running":
+                    return "job failed"
+        except requests.RequestException as error:
+            return type(error).__name__
+
+
+    def measure(self, endpoint, body, start):
+
+        """
+            It runs a request and records its latency from 'start' or its error.
+        """
+
+        error = self.run_request(endpoint, body)
+        latency = time.perf_counter() - start
+
+        with self.lock:
+            if error is None:
+                self.latencies[endpoint].append(latency)
+            else:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+
+    def run_closed_loop(self, concurrency, duration):
+
+        """
+            It runs 'concurrency' clients which send a request as soon as
+            their previous one is answered, during 'duration' seconds.
+        """
+
+        end = time.perf_counter() + duration
+
+        def client():
+            while time.perf_counter() < end:
+                endpoint, body = self.next_request()
+                self.measure(endpoint, body, time.perf_counter())
+
+        clients = [threading.Thread(target = client) for _ in range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+
+
+    def run_open_loop(self, rate, concurrency, duration):
+
+        """
+            It sends 'rate' requests per second (Poisson arrivals) during 'duration'
+            seconds, with at most 'concurrency' requests in flight. A request which
+            cannot be sent on time is still measured from the time it was due.
+        """
+
+        with ThreadPoolExecutor(max_workers = concurrency) as executor:
+            start = time.perf_counter()
+            due = start
+
+            while due < start + duration:
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+                endpoint, body = self.next_request()
+                executor.submit(self.measure, endpoint, body, due)
+
+                with self.random_lock:
+                    due += self.random.expovariate(rate)
+
+
+    def report(self, elapsed):
+
+        """
+            It returns the results of the load test.
+        """
+
+        all_latencies = [latency for latencies in self.latencies.values()
+                         for latency in latencies]
+        num_errors = sum(self.errors.values())
+        num_requests = len(all_latencies) + num_errors
+
+        return {
+            "requests": num_requests,
+            "completed": len(all_latencies),
+            "errors": self.errors,
+            "error_rate": num_errors / num_requests if num_requests else 0.0,
+            "elapsed_seconds": elapsed,
+            "throughput": len(all_latencies) / elapsed,
+            "latency_seconds": percentiles(all_latencies),
+            "endpoints": {endpoint: {"completed": len(latencies), **percentiles(latencies)}
+                          for endpoint, latencies in self.latencies.items()},
+        }
+
+
+def start_server(url, environment):
+
+    """
+        It starts the webserver on the port of the url, with the given
+        NAME=value variables, and waits until it answers.
+    """
+
+    port = url.rstrip('/').rsplit(':', 1)[-1]
+    env = dict(os.environ, **dict(item.split('=', 1) for item in environment))
+
+    #  the server is stopped by main(), once the load test is over
+    server = subprocess.Popen(['flask', '--app', 'api_server', 'run', '--port', port],  # pylint: disable=consider-using-with
+                              env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+    for _ in range(300):
+        try:
+            requests.get(f"{url}/api/num_jobs", timeout = 1)
+            return server
+        except requests.RequestException:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise SystemExit("The webserver did not start")
+
+
+def main():
+
+    """
+        It runs the load test and prints the results as JSON.
+    """
+
+    parser = argparse.ArgumentParser(description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default = 'http://127.0.0.1:5000')
+    parser.add_argument('--tests-dir', default = 'tests')
+    parser.add_argument('--mode', choices = ['closed', 'open'], default = 'closed')
+    parser.add_argument('--concurrency', type = int, default = 8)
+    parser.add_argument('--rate', type = float, default = 100.0,
+                        help = 'requests per second of the open loop')
+    parser.add_argument('--duration', type = float, default = 10.0)
+    parser.add_argument('--mix', default = '',
+                        help = 'endpoint=weight,... (all equally by default)')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--start-server', action = 'store_true',
+                        help = 'start the webserver for the test and stop it afterwards')
+    parser.add_argument('--server-env', nargs = '*', default = [],
+                        help = 'NAME=value variables of the started webserver')
+    args = parser.parse_args()
+
+    load_test = LoadTest(args.url, load_corpus(args.tests_dir), args.mix, args.seed)
+    server = start_server(args.url, args.server_env) if args.start_server else None
+
+    try:
+        start = time.perf_counter()
+        if args.mode == 'closed':
+            load_test.run_closed_loop(args.concurrency, args.duration)
+        else:
+            load_test.run_open_loop(args.rate, args.concurrency, args.duration)
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    results = {
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "rate": args.rate if args.mode == 'open' else None,
+        "duration": args.duration,
+        "mix": dict(zip(load_test.endpoints, load_test.weights)),
+        **load_test.report(elapsed),
+    }
+
+    print(json.dumps(results, indent = 4))
+
+
+if __name__ == '__main__':
+    main()
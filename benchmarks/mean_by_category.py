@@ -0,0 +1,146 @@
+"""
+    Micro-benchmark of get_mean_by_category and get_state_mean_by_category.
+
+    It compares the current implementations with the original ones (a scan of the
+    DataFrame for the question, then a Python loop over the groupby), checks that
+    they give the same results (the means may differ in the last bits, since the
+    sums are not accumulated in the same order) and reports the speedup on the
+    whole dataset.
+
+    Usage (from the repository root):
+        python -m benchmarks.mean_by_category [--repeat N]
+"""
+
+import argparse
+import json
+import math
+import time
+
+from app import webserver
+
+
+def original_mean_by_category(df, question):
+
+    """
+        The original implementation of get_mean_by_category.
+    """
+
+    question_data = df[df['Question'] == question]
+
+    result = {}
+
+    grouped = question_data.groupby(['LocationDesc', 'StratificationCategory1',
+                                     'Stratification1'], observed = True)
+
+    for (state, category, segment), group_data in grouped:
+        key = f"('{state}', '{category}', '{segment}')"
+        result[key] = group_data['Data_Value'].mean()
+
+    return result
+
+
+def original_state_mean_by_category(df, state, question):
+
+    """
+        The original implementation of get_state_mean_by_category.
+    """
+
+    question_data = df[df['Question'] == question]
+    filtered_data = question_data[question_data['LocationDesc'] == state]
+
+    result = {state: {}}
+
+    grouped = filtered_data.groupby(['StratificationCategory1', 'Stratification1'],
+                                    observed = True)
+
+    for (category, segment), group_data in grouped:
+        key = f"('{category}', '{segment}')"
+        result[state][key] = group_data['Data_Value'].mean()
+
+    return result
+
+
+def time_calls(calls, repeat):
+
+    """
+        It returns the total duration of all the calls, in seconds,
+        together with the results of the last round.
+    """
+
+    results = []
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        results = [call() for call in calls]
+
+    return time.perf_counter() - start, results
+
+
+def same_results(expected, actual):
+
+    """
+        It checks that two results have the same keys and the same values, up to
+        the last bits that depend on the summation order (NaN being equal to NaN).
+    """
+
+    if isinstance(expected, dict):
+        return (isinstance(actual, dict) and expected.keys() == actual.keys() and
+                all(same_results(expected[key], actual[key]) for key in expected))
+
+    if math.isnan(expected):
+        return math.isnan(actual)
+
+    return math.isclose(expected, actual, rel_tol = 1e-12)
+
+
+def main():
+
+    """
+        It times both implementations of both methods, for every question (and every
+        state for get_state_mean_by_category), and prints the results as JSON.
+    """
+
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--repeat', type = int, default = 5)
+    args = parser.parse_args()
+
+    webserver.tasks_runner.shutdown()
+    data_ingestor = webserver.data_ingestor
+    df = data_ingestor.df
+
+    questions = sorted(data_ingestor.question_index)
+    states = sorted(df['LocationDesc'].dropna().unique())
+
+    # pylint: disable=unnecessary-lambda-assignment
+    benchmarks = {
+        "get_mean_by_category": (
+            [lambda q = question: original_mean_by_category(df, q) for question in questions],
+            [lambda q = question: data_ingestor.get_mean_by_category(q) for question in questions],
+        ),
+        "get_state_mean_by_category": (
+            [lambda s = state, q = question: original_state_mean_by_category(df, s, q)
+             for question in questions for state in states],
+            [lambda s = state, q = question: data_ingestor.get_state_mean_by_category(s, q)
+             for question in questions for state in states],
+        ),
+    }
+
+    report = {}
+    for method, (original_calls, current_calls) in benchmarks.items():
+        original_seconds, original_results = time_calls(original_calls, args.repeat)
+        current_seconds, current_results = time_calls(current_calls, args.repeat)
+
+        report[method] = {
+            "calls": len(current_calls) * args.repeat,
+            "original_seconds": original_seconds,
+            "current_seconds": current_seconds,
+            "speedup": original_seconds / current_seconds,
+            "identical_output": all(same_results(expected, actual) for expected, actual
+                                    in zip(original_results, current_results)),
+        }
+
+    print(json.dumps(report, indent = 4))
+
+
+if __name__ == '__main__':
+    main()
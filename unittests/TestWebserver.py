@@ -2,12 +2,31 @@
     Unit tests for the web server application.
 """
 
+import os
 import unittest
 import time
 import json
+import tempfile
+import threading
+import queue
+import logging
+from unittest.mock import patch
+import numpy as np
+import pandas as pd
 
-from app import webserver
+from app import webserver, routes
 from app.data_ingestor import DataIngestor
+from app.result_cache import ResultCache, MISSING
+from app.result_store import ResultStore, FileResultStore, MemoryResultStore, SegmentLogResultStore
+from app.task_runner import ThreadPool, TaskRunner, TaskCosts
+from app.job_registry import JobRegistry
+from app.dataset_reloader import DatasetReloader
+from app.scheduler import FairScheduler
+from app.admission import AdmissionControl
+from app.metrics import Histogram, bucket_index, bucket_upper_bound
+from app.profiler import SamplingProfiler
+from app.webserver_log import (BatchRotatingFileHandler, BatchLogWriter, DroppingQueueHandler,
+                               sample_records, get_log_stats, format_time_utc)
 
 class TestWebserver(unittest.TestCase):
 
@@ -27,7 +46,8 @@ class TestWebserver(unittest.TestCase):
         self.webserver = webserver
         self.webserver.testing = True
         self.client = self.webserver.test_client()
-        self.data_ingestor = DataIngestor('./nutrition_activity_obesity_usa_subset.csv')
+        self.data_ingestor = DataIngestor('./nutrition_activity_obesity_usa_subset.csv',
+                                          snapshot_dir = 'snapshot')
 
 
     def test_csv_read_correctly(self):
@@ -141,6 +161,7 @@ class TestWebserver(unittest.TestCase):
 
         self.assertEqual(response_data["status"], "done")
         self.assertTrue("remaining_jobs" in response_data)
+        self.assertTrue("unfinished_jobs" in response_data)
     
 
     def test_post_num_job(self):
@@ -161,3 +182,876 @@ class TestWebserver(unittest.TestCase):
                     self.assertEqual(response_data["error"], "Method not allowed")
             except json.JSONDecodeError:
                 pass  # If not JSON, that's okay for a 405 response
+
+
+    def test_question_index_matches_scan(self):
+
+        """
+            This test verifies that the precomputed question index gives the same
+            averages as scanning the DataFrame.
+        """
+
+        question = self.data_ingestor.df['Question'].iloc[0]
+        question_data = self.data_ingestor.df[self.data_ingestor.df['Question'] == question]
+
+        expected_means = question_data.groupby('LocationDesc')['Data_Value'].mean()
+        states_mean = self.data_ingestor.get_states_mean(question)
+
+        self.assertEqual(set(states_mean), set(expected_means.index))
+        for state, mean in expected_means.items():
+            self.assertAlmostEqual(states_mean[state], mean)
+
+        global_mean = self.data_ingestor.get_global_mean(question)["global_mean"]
+        self.assertAlmostEqual(global_mean, question_data['Data_Value'].mean())
+
+        self.assertEqual(self.data_ingestor.get_states_mean("Unknown question"), {})
+
+
+    def test_cache_stats(self):
+
+        """
+            This test verifies that the cache_stats endpoint returns the cache counters.
+        """
+
+        response = self.client.get("/api/cache_stats")
+        self.assertEqual(response.status_code, 200)
+        response_data = json.loads(response.data)
+
+        self.assertEqual(response_data["status"], "done")
+        for counter in ["hits", "misses", "evictions"]:
+            self.assertIn(counter, response_data["data"])
+
+
+    def test_result_cache_eviction(self):
+
+        """
+            This test verifies that the results cache evicts the least recently used
+            entry and drops everything on invalidation.
+        """
+
+        cache = ResultCache(max_entries = 2, max_bytes = 1024)
+
+        cache.put("a", b'{"a": 1.0}', cache.generation)
+        cache.put("b", b'{"b": 2.0}', cache.generation)
+        self.assertEqual(cache.get("a"), b'{"a": 1.0}')
+
+        cache.put("c", b'{"c": 3.0}', cache.generation)
+        self.assertIs(cache.get("b"), MISSING)
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+
+        stale_generation = cache.generation
+        cache.invalidate()
+        cache.put("d", b'{"d": 4.0}', stale_generation)
+        self.assertIs(cache.get("a"), MISSING)
+        self.assertIs(cache.get("d"), MISSING)
+
+
+    def test_compact_ingestion(self):
+
+        """
+            This test verifies that the compact (categorical) ingestion mode gives
+            the same results as the default one.
+        """
+
+        compact_ingestor = DataIngestor('./nutrition_activity_obesity_usa_subset.csv',
+                                        compact = True, value_dtype = 'float32')
+
+        self.assertEqual(str(compact_ingestor.df['Question'].dtype), 'category')
+        self.assertEqual(str(compact_ingestor.df['Data_Value'].dtype), 'float32')
+
+        question = self.data_ingestor.df['Question'].iloc[0]
+        expected = self.data_ingestor.get_mean_by_category(question)
+        result = compact_ingestor.get_mean_by_category(question)
+
+        pd.testing.assert_series_equal(pd.Series(result), pd.Series(expected), rtol = 1e-5)
+
+
+    def test_sync_request(self):
+
+        """
+            This test verifies that a synchronous request is answered inline once the
+            task is known to be cheap, and that it falls back to a job_id otherwise
+            (and for invalid arguments), an invalid budget being rejected.
+        """
+
+        question = self.data_ingestor.df['Question'].iloc[0]
+        data = {"question": question, "sync": True, "budget_ms": 0}
+
+        #  the shutdown test may have run before
+        with patch.object(webserver, 'shutting_down', False, create = True):
+            response_data = json.loads(self.client.post("/api/global_mean", json = data).data)
+            self.assertIn("job_id", response_data)
+
+            data["budget_ms"] = 10000
+            webserver.tasks_runner.task_costs.record("get_states_mean", 0.001)
+
+            response_data = json.loads(self.client.post("/api/states_mean", json = data).data)
+            self.assertEqual(response_data["status"], "done")
+            self.assertEqual(response_data["data"],
+                             self.data_ingestor.get_states_mean(question))
+
+            invalid_question = self.client.post("/api/states_mean",
+                                                json = {**data, "question": [question]})
+            invalid_budget = self.client.post("/api/states_mean",
+                                              json = {**data, "budget_ms": "fast"})
+
+        self.assertEqual(invalid_question.status_code, 200)
+        self.assertIn("job_id", json.loads(invalid_question.data))
+        self.assertEqual(json.loads(invalid_budget.data),
+                         {"status": "error", "reason": "Invalid budget_ms"})
+
+
+    def test_result_stores(self):
+
+        """
+            This test verifies that every result store gives back the encoded results,
+            the last one when a result is stored again.
+        """
+
+        with tempfile.TemporaryDirectory() as directory:
+            stores = [
+                FileResultStore(directory),
+                MemoryResultStore(ttl = 60, max_bytes = 1024),
+                SegmentLogResultStore(directory, segment_bytes = 16, max_segments = 2),
+            ]
+
+            for store in stores:
+                store.put(1, b'{"Alabama": 1.5}')
+                store.put(2, b'{"Alaska": 2.5}')
+
+                self.assertEqual(store.get(1), b'{"Alabama": 1.5}')
+                self.assertEqual(store.get(2), b'{"Alaska": 2.5}')
+                self.assertIsNone(store.get(3))
+
+            #  the segments of the first results are dropped
+            segment_store = stores[2]
+            segment_store.put(3, b'{"Arizona": 3.5}')
+            self.assertIsNone(segment_store.get(1))
+            self.assertEqual(segment_store.get(3), b'{"Arizona": 3.5}')
+
+            #  a result stored again replaces the previous one, in the size too
+            memory_store = stores[1]
+            memory_store.put(2, b'{"Alaska": 3.5}')
+            self.assertEqual(memory_store.get(2), b'{"Alaska": 3.5}')
+            self.assertEqual(memory_store.current_bytes,
+                             len(b'{"Alabama": 1.5}') + len(b'{"Alaska": 3.5}'))
+
+            #  the segment of the previous result is dropped, not the new result
+            segment_store = SegmentLogResultStore(os.path.join(directory, 'again'),
+                                                  segment_bytes = 16, max_segments = 2)
+            segment_store.put(1, b'{"Alabama": 1.5}')
+            segment_store.put(1, b'{"Alabama": 2.5}')
+            self.assertEqual(segment_store.get(1), b'{"Alabama": 2.5}')
+
+            with self.assertRaises(TypeError):
+                ResultStore()   # pylint: disable=abstract-class-instantiated
+
+
+    def test_batch(self):
+
+        """
+            This test verifies that a batch gives the same results as the separate
+            queries and that invalid items (or too many of them) are rejected.
+        """
+
+        question = self.data_ingestor.df['Question'].iloc[0]
+        state = self.data_ingestor.df['LocationDesc'].iloc[0]
+
+        queries = [
+            ["get_best5", [question]],
+            ["get_diff_from_mean", [question]],
+            ["get_state_diff_from_mean", [state, question]],
+            ["get_best5", [question]],
+        ]
+
+        results = self.data_ingestor.get_batch(queries)
+        for (task_type, args), result in zip(queries, results):
+            self.assertEqual(result, getattr(self.data_ingestor, task_type)(*args))
+
+        batch_result = json.loads(webserver.tasks_runner.execute_batch(queries))
+        self.assertEqual(len(batch_result), len(queries))
+        self.assertEqual(batch_result[0], batch_result[3])
+
+        invalid_items = [[{"endpoint": "state_mean", "question": question}], "abc", [1],
+                         [{"endpoint": "best5", "question": [question]}],
+                         [{"endpoint": "best5", "question": question}] * (routes.BATCH_MAX_ITEMS + 1)]
+
+        with patch.object(webserver, 'shutting_down', False, create = True):
+            responses = [self.client.post("/api/batch", json = {"items": items})
+                         for items in invalid_items]
+
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data),
+                             {"status": "error", "reason": "Invalid batch item"})
+
+
+    def test_process_backend(self):
+
+        """
+            This test verifies that the process backend computes the same results
+            as the data ingestor and reports the job status, and that a task is not
+            computed by workers forked with another dataset than its own.
+        """
+
+        question = self.data_ingestor.df['Question'].iloc[0]
+        environment = {"TP_BACKEND": "process", "TP_NUM_OF_THREADS": "2",
+                       "TP_RESULT_STORE": "memory"}
+
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'data.csv')
+            self.data_ingestor.df.head(200).to_csv(csv_path, index = False)
+            other_data_ingestor = DataIngestor(csv_path)
+
+        with patch.dict(os.environ, environment):
+            threadpool = ThreadPool(self.data_ingestor)
+
+        job_id = threadpool.submit("get_best5", [question])
+
+        for _ in range(100):
+            if threadpool.get_job_status(job_id)["status"] == "completed":
+                break
+            time.sleep(0.05)
+
+        #  the dataset is replaced (and the workers forked again) during the execution
+        def replace_dataset(*_args):
+            threadpool.set_data_ingestor(other_data_ingestor)
+            return MISSING
+
+        with patch.object(threadpool, 'get_materialized', side_effect = replace_dataset):
+            global_mean = threadpool.execute("get_global_mean", [question])
+
+        other_result = threadpool.execute("get_global_mean", [question])
+
+        threadpool.shutdown()
+
+        self.assertEqual(threadpool.get_job_status(job_id)["status"], "completed")
+        self.assertEqual(json.loads(threadpool.result_store.get(job_id)),
+                         self.data_ingestor.get_best5(question))
+        self.assertEqual(json.loads(global_mean), self.data_ingestor.get_global_mean(question))
+        self.assertEqual(json.loads(other_result), other_data_ingestor.get_global_mean(question))
+
+
+    def test_job_registry(self):
+
+        """
+            This test verifies that concurrent submissions get unique job ids
+            and that the registry counts the jobs in every status.
+        """
+
+        job_registry = JobRegistry()
+        job_ids = []
+
+        def allocate_jobs():
+            for _ in range(500):
+                job_ids.append(job_registry.allocate("get_best5"))
+
+        threads = [threading.Thread(target = allocate_jobs) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(job_ids), list(range(1, 2001)))
+        self.assertEqual(job_registry.num_jobs(), 2000)
+
+        job_registry.set_status(7, "completed", 3)
+
+        self.assertEqual(job_registry.get(7),
+                         {"status": "completed", "task_type": "get_best5", "worker": 3})
+        self.assertEqual(job_registry.get(8),
+                         {"status": "pending", "task_type": "get_best5", "worker": None})
+        self.assertIsNone(job_registry.get(2001))
+        self.assertEqual(job_registry.count("completed"), 1)
+        self.assertEqual(job_registry.count("pending"), 1999)
+
+
+    def test_jobs_pagination(self):
+
+        """
+            This test verifies the pagination, the filters and the NDJSON format of /api/jobs.
+        """
+
+        job_registry = JobRegistry()
+        for task_type in ["get_best5", "get_worst5"] * 5:
+            job_registry.allocate(task_type)
+        job_registry.set_status(3, "completed", 0)
+
+        with patch.object(webserver.tasks_runner, 'job_registry', job_registry):
+            first_page = json.loads(self.client.get("/api/jobs?limit=4").data)
+            last_page = json.loads(self.client.get("/api/jobs?limit=4&cursor=8").data)
+            filtered = json.loads(self.client.get(
+                "/api/jobs?status=pending&task_type=get_best5").data)
+            ndjson = self.client.get("/api/jobs?format=ndjson&cursor=8").data.decode()
+            invalid = json.loads(self.client.get("/api/jobs?status=unknown").data)
+
+        self.assertEqual([list(job)[0] for job in first_page["data"]], ["1", "2", "3", "4"])
+        self.assertEqual(first_page["next_cursor"], 4)
+        self.assertEqual([list(job)[0] for job in last_page["data"]], ["9", "10"])
+        self.assertIsNone(last_page["next_cursor"])
+        self.assertEqual([list(job)[0] for job in filtered["data"]], ["1", "5", "7", "9"])
+        self.assertEqual([json.loads(line) for line in ndjson.splitlines()], [
+            {"9": {"status": "pending", "task_type": "get_best5", "worker": None}},
+            {"10": {"status": "pending", "task_type": "get_worst5", "worker": None}},
+            {"next_cursor": None},
+        ])
+        self.assertEqual(invalid, {"status": "error", "reason": "Invalid status"})
+
+
+    def test_long_poll_and_events(self):
+
+        """
+            This test verifies that a long-poll request and the event stream
+            return the results as soon as the jobs are completed.
+        """
+
+        job_registry = JobRegistry()
+        result_store = MemoryResultStore(60, 1024)
+
+        for job_id in [job_registry.allocate("get_global_mean") for _ in range(2)]:
+            result_store.put(job_id, json.dumps({"global_mean": job_id}).encode())
+
+        def complete_jobs():
+            for job_id in [1, 2]:
+                time.sleep(0.1)
+                job_registry.set_status(job_id, "completed", 0)
+
+        completer = threading.Thread(target = complete_jobs)
+
+        with patch.object(webserver.tasks_runner, 'job_registry', job_registry), \
+             patch.object(webserver.tasks_runner, 'result_store', result_store):
+            self.assertEqual(json.loads(self.client.get("/api/get_results/1").data),
+                             {"status": "running"})
+
+            completer.start()
+            long_poll = json.loads(self.client.get("/api/get_results/1?wait=5").data)
+            events = self.client.get("/api/events?job_ids=1,2").data.decode()
+            completer.join()
+
+        self.assertEqual(long_poll, {"status": "done", "data": {"global_mean": 1}})
+        self.assertEqual(events,
+                         'id: 1\nevent: result\n'
+                         'data: {"status": "done", "data": {"global_mean": 1}}\n\n'
+                         'id: 2\nevent: result\n'
+                         'data: {"status": "done", "data": {"global_mean": 2}}\n\n')
+
+
+    def test_async_logging(self):
+
+        """
+            This test verifies that the records are dropped when the queue is full,
+            that the sampled records are thinned, that the queued records are written
+            and that they are timestamped with their creation time.
+        """
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.log')
+            file_handler = BatchRotatingFileHandler(path, maxBytes = 1024 * 1024,
+                                                    backupCount = 1, encoding = 'utf-8')
+            records = queue.Queue(3)
+
+            test_logger = logging.getLogger('test_async_logging')
+            test_logger.setLevel(logging.INFO)
+            test_logger.propagate = False
+            test_logger.addHandler(DroppingQueueHandler(records))
+            test_logger.addFilter(sample_records(2))
+
+            log_stats_before = get_log_stats()
+
+            for index in range(5):
+                test_logger.info("record %d", index)
+            for index in range(4):
+                test_logger.info("poll %d", index, extra = {"sampled": True})
+
+            log_stats = get_log_stats()
+            self.assertEqual(log_stats["sampled_out"] - log_stats_before["sampled_out"], 2)
+            self.assertEqual(log_stats["dropped"] - log_stats_before["dropped"], 4)
+
+            log_writer = BatchLogWriter(records, file_handler, 2)
+            log_writer.start()
+            log_writer.stop()
+            file_handler.close()
+
+            with open(path, 'r', encoding = 'utf-8') as log_file:
+                self.assertEqual(log_file.read().splitlines(),
+                                 ["record 0", "record 1", "record 2"])
+
+        #  the timestamp is the creation time of the record, not the time it is written
+        record = logging.LogRecord('test', logging.INFO, __file__, 0, "record", None, None)
+        record.created = 0.0
+        self.assertEqual(format_time_utc(record), '1970-01-01 00:00:00')
+
+
+    def test_snapshot(self):
+
+        """
+            This test verifies that the snapshot gives the same data as the csv file
+            and that it is not used anymore once the csv file changes.
+        """
+
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'data.csv')
+            self.data_ingestor.df.head(200).to_csv(csv_path, index = False)
+
+            for compact in [False, True]:
+                from_csv = DataIngestor(csv_path, compact = compact, snapshot_dir = directory)
+                from_snapshot = DataIngestor(csv_path, compact = compact, snapshot_dir = directory)
+
+                self.assertEqual(from_csv.load_report["loaded_from"], 'csv')
+                self.assertEqual(from_snapshot.load_report["loaded_from"], 'snapshot')
+                pd.testing.assert_frame_equal(from_csv.df, from_snapshot.df)
+
+                #  the values (and the categorical codes) are the memory-mapped ones, not a copy
+                mapped = [from_snapshot.df['Data_Value'].to_numpy()]
+                if compact:
+                    mapped.append(from_snapshot.df['Question'].array.codes)
+
+                for values in mapped:
+                    while values.base is not None and not isinstance(values, np.memmap):
+                        values = values.base
+                    self.assertIsInstance(values, np.memmap)
+
+            self.data_ingestor.df.head(100).to_csv(csv_path, index = False)
+            changed = DataIngestor(csv_path, snapshot_dir = directory)
+
+            self.assertEqual(changed.load_report["loaded_from"], 'csv')
+            self.assertEqual(len(changed.df), 100)
+
+
+    def test_reload_dataset(self):
+
+        """
+            This test verifies that a reload reuses the unchanged questions, drops only
+            the cached results of the changed ones and that the jobs submitted before
+            the reload are computed on the previous dataset, and that the endpoint
+            is disabled by default.
+        """
+
+        questions = self.data_ingestor.df['Question'].unique()[:2]
+
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'data.csv')
+            df = self.data_ingestor.df[self.data_ingestor.df['Question'].isin(questions)]
+            df.to_csv(csv_path, index = False)
+
+            with patch.dict(os.environ, {"TP_NUM_OF_THREADS": "1", "TP_RESULT_STORE": "memory"}):
+                threadpool = ThreadPool(DataIngestor(csv_path))
+
+            reloader = DatasetReloader(threadpool, lambda path, previous:
+                                       DataIngestor(path, previous = previous), csv_path)
+
+            old_means = [threadpool.execute("get_global_mean", [question])
+                         for question in questions]
+
+            changed_df = df.copy()
+            changed_df.loc[changed_df['Question'] == questions[0], 'Data_Value'] += 1
+            changed_df.to_csv(csv_path, index = False)
+
+            old_data_ingestor = threadpool.data_ingestor
+            self.assertTrue(reloader.reload())
+            reloader.reload_thread.join()
+
+            stale_result = threadpool.execute("get_global_mean", [questions[0]],
+                                              data_ingestor = old_data_ingestor)
+            threadpool.shutdown()
+
+        self.assertEqual(reloader.status["state"], "idle")
+        self.assertEqual(reloader.status["version"], 2)
+        self.assertEqual(reloader.status["changed_questions"], 1)
+        self.assertEqual(reloader.status["reused_questions"], 1)
+        self.assertEqual(threadpool.result_cache.get_stats()["entries"], 1)
+
+        self.assertEqual(stale_result, old_means[0])
+        self.assertAlmostEqual(json.loads(threadpool.execute("get_global_mean", [questions[0]]))
+                               ["global_mean"],
+                               json.loads(old_means[0])["global_mean"] + 1)
+        self.assertEqual(threadpool.execute("get_global_mean", [questions[1]]), old_means[1])
+
+        #  the endpoint only reloads once enabled, its status is always available
+        self.assertEqual(self.client.post("/api/reload_dataset").status_code, 403)
+        self.assertEqual(json.loads(self.client.get("/api/reload_dataset").data)["status"], "done")
+
+
+    def test_append_rows(self):
+
+        """
+            This test verifies that appending rows gives the same results as loading
+            all the rows at once, that the rows can be appended as JSON or csv and
+            that the endpoint is disabled by default.
+        """
+
+        df = self.data_ingestor.df
+        question = df['Question'].iloc[0]
+
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'data.csv')
+            df.iloc[:len(df) // 2].to_csv(csv_path, index = False)
+            data_ingestor = DataIngestor(csv_path)
+
+        rows = df.iloc[len(df) // 2:]
+        json_rows = json.loads(rows.iloc[:100].to_json(orient = 'records'))
+        csv_rows = rows.iloc[100:].to_csv(index = False)
+
+        with patch.object(webserver.tasks_runner, 'data_ingestor', data_ingestor):
+            disabled_response = self.client.post("/api/append_rows", json = {"rows": json_rows})
+
+        with patch.object(webserver.tasks_runner, 'data_ingestor', data_ingestor), \
+             patch.object(routes, 'APPEND_ROWS_ENABLED', True):
+            json_response = json.loads(self.client.post("/api/append_rows",
+                                                         json = {"rows": json_rows}).data)
+            csv_response = json.loads(self.client.post("/api/append_rows", data = csv_rows,
+                                                       content_type = 'text/csv').data)
+            invalid_response = json.loads(self.client.post("/api/append_rows",
+                                                           json = {"rows": [{"Question": 1}]}).data)
+
+        self.assertEqual(disabled_response.status_code, 403)
+        self.assertEqual(json_response["status"], "done")
+        self.assertEqual(csv_response["status"], "done")
+        self.assertEqual(invalid_response, {"status": "error", "reason": "Invalid rows"})
+        self.assertEqual(len(data_ingestor.df), len(df))
+
+        for task_type in ["get_states_mean", "get_global_mean", "get_mean_by_category"]:
+            expected = getattr(self.data_ingestor, task_type)(question)
+            result = getattr(data_ingestor, task_type)(question)
+
+            self.assertEqual(result.keys(), expected.keys())
+            pd.testing.assert_series_equal(pd.Series(result)[list(expected)], pd.Series(expected))
+
+
+    def test_streaming_ingestion(self):
+
+        """
+            This test verifies that reading the csv file in chunks keeps no rows
+            and gives the same results as reading it at once.
+        """
+
+        streamed = DataIngestor('./nutrition_activity_obesity_usa_subset.csv', chunksize = 1000)
+        question = self.data_ingestor.df['Question'].iloc[0]
+        state = self.data_ingestor.df['LocationDesc'].iloc[0]
+
+        self.assertIsNone(streamed.df)
+        self.assertEqual(streamed.get_question_fingerprints(),
+                         self.data_ingestor.get_question_fingerprints())
+
+        for task_type, args in [("get_states_mean", [question]),
+                                ("get_global_mean", [question]),
+                                ("get_mean_by_category", [question]),
+                                ("get_state_mean_by_category", [state, question])]:
+            expected = getattr(self.data_ingestor, task_type)(*args)
+            result = getattr(streamed, task_type)(*args)
+
+            self.assertEqual(result.keys(), expected.keys())
+            pd.testing.assert_series_equal(pd.Series(result)[list(expected)], pd.Series(expected))
+
+
+    def test_fair_scheduler(self):
+
+        """
+            This test verifies that the priority classes are served in order and that,
+            inside a class, a client with many expensive tasks does not starve the others.
+        """
+
+        task_costs = TaskCosts()
+        task_costs.record("get_mean_by_category", 0.01)
+        task_costs.record("get_best5", 0.001)
+
+        scheduler = FairScheduler(task_costs)
+
+        for index in range(100):
+            scheduler.put(("heavy", index), "get_mean_by_category", "normal", "client_a")
+        for index in range(10):
+            scheduler.put(("light", index), "get_best5", "normal", "client_b")
+        scheduler.put(("urgent", 0), "get_state_mean", None, "client_c")
+
+        self.assertEqual(scheduler.get(timeout = 0), ("urgent", 0))
+
+        served = [scheduler.get(timeout = 0) for _ in range(20)]
+
+        #  the cheap tasks of client_b are all served before most heavy tasks of client_a
+        self.assertEqual(sum(1 for task in served if task[0] == "light"), 10)
+        self.assertEqual(scheduler.qsize(), 90)
+        self.assertEqual(scheduler.get_stats()["normal"]["depth"], 90)
+        self.assertEqual(scheduler.get_stats()["high"]["served"], 1)
+
+        for _ in range(90):
+            scheduler.get(timeout = 0)
+
+        self.assertTrue(scheduler.empty())
+        with self.assertRaises(queue.Empty):
+            scheduler.get(timeout = 0)
+
+
+    def test_coalescing(self):
+
+        """
+            This test verifies that identical jobs submitted while the first one is
+            pending are computed once and completed together, unless rows were
+            appended to the dataset in the meantime.
+        """
+
+        question = self.data_ingestor.df['Question'].iloc[0]
+        environment = {"TP_NUM_OF_THREADS": "0", "TP_RESULT_STORE": "memory"}
+
+        with patch.dict(os.environ, environment):
+            threadpool = ThreadPool(self.data_ingestor)
+
+        with patch.object(threadpool, 'compute', wraps = threadpool.compute) as compute:
+            #  the jobs are submitted before there is any task runner
+            job_ids = [threadpool.submit("get_best5", [question]) for _ in range(5)]
+            other_job_id = threadpool.submit("get_worst5", [question])
+
+            with patch.object(DataIngestor, 'append_rows', return_value = {question}):
+                threadpool.append_rows([])
+            appended_job_id = threadpool.submit("get_best5", [question])
+
+            task_runner = TaskRunner(0, threadpool)
+            task_runner.start()
+            threadpool.task_runners.append(task_runner)
+
+            for _ in range(100):
+                if threadpool.job_registry.count("completed") == 7:
+                    break
+                time.sleep(0.05)
+
+        threadpool.shutdown()
+
+        #  the job submitted after the append has its own task (which finds the result
+        #  cached by the first one, computed after the append)
+        self.assertEqual(compute.call_count, 2)
+        self.assertEqual(threadpool.coalesced_jobs, 4)
+        self.assertEqual(threadpool.in_flight, {})
+
+        for job_id in job_ids + [appended_job_id]:
+            self.assertEqual(threadpool.get_job_status(job_id)["status"], "completed")
+            self.assertEqual(json.loads(threadpool.result_store.get(job_id)),
+                             self.data_ingestor.get_best5(question))
+
+        self.assertEqual(json.loads(threadpool.result_store.get(other_job_id)),
+                         self.data_ingestor.get_worst5(question))
+
+
+    def test_failed_jobs(self):
+
+        """
+            This test verifies that the jobs of a task which raises an error are marked
+            as failed, coalesced ones included, and that the task runner keeps working.
+        """
+
+        question = self.data_ingestor.df['Question'].iloc[0]
+        environment = {"TP_NUM_OF_THREADS": "0", "TP_RESULT_STORE": "memory"}
+
+        with patch.dict(os.environ, environment):
+            threadpool = ThreadPool(self.data_ingestor)
+
+        #  a list is not a valid question, the lookup raises a TypeError
+        failed_job_ids = [threadpool.submit("get_best5", [["x"]]) for _ in range(2)]
+        job_id = threadpool.submit("get_best5", [question])
+
+        task_runner = TaskRunner(0, threadpool)
+        task_runner.start()
+        threadpool.task_runners.append(task_runner)
+
+        threadpool.job_registry.wait_completed([job_id], 5)
+        threadpool.shutdown()
+
+        for failed_job_id in failed_job_ids:
+            self.assertEqual(threadpool.get_job_status(failed_job_id)["status"], "failed")
+        self.assertEqual(threadpool.in_flight, {})
+        self.assertEqual(threadpool.get_job_status(job_id)["status"], "completed")
+        self.assertEqual(json.loads(threadpool.result_store.get(job_id)),
+                         self.data_ingestor.get_best5(question))
+
+
+    def test_admission_control(self):
+
+        """
+            This test verifies that a client over its rate limit gets a 429 response, even
+            if it changes its X-Client-Id header (unless the header is trusted), and that
+            a job is rejected with a 503 response when the queue is full.
+        """
+
+        question = self.data_ingestor.df['Question'].iloc[0]
+        admission = AdmissionControl(max_queue_depth = 10, client_rate = 1, client_burst = 2)
+
+        self.assertIsNone(admission.check_rate("client_a"))
+        self.assertIsNone(admission.check_rate("client_a"))
+        self.assertGreater(admission.check_rate("client_a"), 0)
+        self.assertIsNone(admission.check_rate("client_b"))
+        self.assertIsNone(admission.check_depth(9, 1.0))
+        self.assertEqual(admission.check_depth(10, 1.0), 1.0)
+
+        tasks_runner = webserver.tasks_runner
+        trusted_admission = AdmissionControl(max_queue_depth = 0, client_rate = 1, client_burst = 1)
+
+        with patch.object(webserver, 'shutting_down', False, create = True), \
+             patch.object(tasks_runner, 'admission', admission):
+            responses = [self.client.post("/api/best5", json = {"question": question},
+                                          headers = {"X-Client-Id": f"client_{index}"})
+                         for index in range(3)]
+
+            with patch.object(tasks_runner.tasks_queue, 'qsize', return_value = 10):
+                overloaded = self.client.post("/api/best5", json = {"question": question},
+                                              environ_base = {"REMOTE_ADDR": "10.0.0.2"})
+
+            with patch.object(routes, 'TRUST_CLIENT_ID', True), \
+                 patch.object(tasks_runner, 'admission', trusted_admission):
+                trusted = [self.client.post("/api/best5", json = {"question": question},
+                                            headers = {"X-Client-Id": f"client_{index}"})
+                           for index in range(3)]
+
+        self.assertEqual([response.status_code for response in responses], [200, 200, 429])
+        self.assertEqual([response.status_code for response in trusted], [200, 200, 200])
+        self.assertGreaterEqual(int(responses[2].headers["Retry-After"]), 1)
+        self.assertEqual(overloaded.status_code, 503)
+        self.assertEqual(json.loads(overloaded.data),
+                         {"status": "error", "reason": "Server overloaded"})
+        self.assertEqual(admission.get_stats()["rate_limited"], 2)
+        self.assertEqual(admission.get_stats()["queue_full"], 2)
+
+
+    def test_metrics(self):
+
+        """
+            This test verifies the precision of the histograms and that a job
+            shows up in the Prometheus metrics.
+        """
+
+        for value in [0, 1, 15, 16, 17, 1000, 123456, 10 ** 9]:
+            upper_bound = bucket_upper_bound(bucket_index(value))
+            self.assertGreater(upper_bound, value)
+            self.assertLessEqual(upper_bound, max(value * 1.07, value + 1))
+
+        histogram = Histogram()
+        for milliseconds in range(1, 101):
+            histogram.record(milliseconds / 1000)
+
+        self.assertAlmostEqual(histogram.percentile(50), 0.05, delta = 0.004)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta = 0.007)
+
+        question = self.data_ingestor.df['Question'].iloc[0]
+
+        with patch.dict(os.environ, {"TP_NUM_OF_THREADS": "1", "TP_RESULT_STORE": "memory"}):
+            threadpool = ThreadPool(self.data_ingestor)
+
+        job_id = threadpool.submit("get_worst5", [question])
+        threadpool.job_registry.wait_completed([job_id], 10)
+        threadpool.shutdown()
+
+        with patch.object(webserver, 'tasks_runner', threadpool):
+            response = self.client.get("/api/metrics")
+
+        metrics = response.data.decode()
+
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertIn('tp_queue_wait_seconds_count{task_type="get_worst5"}', metrics)
+        self.assertIn('tp_result_write_seconds_bucket{task_type="get_worst5",le="+Inf"}', metrics)
+        self.assertIn('tp_worker_utilization{worker=', metrics)
+        self.assertIn('tp_jobs{status="completed"}', metrics)
+
+
+    def test_profiler(self):
+
+        """
+            This test verifies that the profiler samples the stacks of the other threads
+            and that the profile endpoint, once enabled, returns them as collapsed stacks.
+        """
+
+        stop = threading.Event()
+
+        def busy_loop():
+            while not stop.is_set():
+                sum(range(1000))
+
+        busy_thread = threading.Thread(target = busy_loop, name = "busy")
+        busy_thread.start()
+
+        sampling_profiler = SamplingProfiler()
+        concurrent_profiles = []
+        concurrent_profiler = threading.Thread(target = lambda: concurrent_profiles.append(
+            sampling_profiler.profile(0.1, 0.01)))
+
+        with sampling_profiler.lock:
+            concurrent_profiler.start()
+            concurrent_profiler.join()
+
+        stacks, samples = sampling_profiler.profile(0.2, 0.01, all_threads = True)
+        stop.set()
+        busy_thread.join()
+
+        self.assertEqual(concurrent_profiles, [None])
+        self.assertGreater(samples, 0)
+        self.assertTrue(any(stack.startswith("busy;") and "busy_loop (unittests/TestWebserver.py"
+                            in stack for stack in stacks))
+
+        disabled_response = self.client.get("/api/profile?seconds=0.1&interval_ms=5")
+
+        with patch.object(routes, 'PROFILE_ENABLED', True):
+            response = self.client.get("/api/profile?seconds=0.1&interval_ms=5")
+
+        self.assertEqual(disabled_response.status_code, 403)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertGreater(int(response.headers["X-Profile-Samples"]), 0)
+
+
+    def test_materialization(self):
+
+        """
+            This test verifies that the materialized results complete the jobs at once,
+            that they follow the appended rows and that they are reused on the next start.
+        """
+
+        question = self.data_ingestor.df['Question'].iloc[0]
+        state = self.data_ingestor.df['LocationDesc'].iloc[0]
+
+        def wait_ready(threadpool):
+            for _ in range(200):
+                if threadpool.materializer.get_stats()["state"] == "ready":
+                    break
+                time.sleep(0.05)
+            return threadpool.materializer.get_stats()
+
+        with tempfile.TemporaryDirectory() as directory:
+            environment = {"TP_NUM_OF_THREADS": "1", "TP_RESULT_STORE": "memory",
+                           "TP_MATERIALIZE": "1", "TP_MATERIALIZE_DIR": directory}
+
+            with patch.dict(os.environ, environment):
+                threadpool = ThreadPool(self.data_ingestor)
+                stats = wait_ready(threadpool)
+
+                job_id = threadpool.submit("get_state_mean", [state, question])
+                job_status = threadpool.get_job_status(job_id)["status"]
+                job_result = json.loads(threadpool.result_store.get(job_id))
+                expected_result = self.data_ingestor.get_state_mean(state, question)
+
+                df = self.data_ingestor.df
+                rows = df[df['Question'] == question].iloc[:10]
+                combined_csv_path = os.path.join(directory, 'combined.csv')
+                pd.concat([df, rows]).to_csv(combined_csv_path, index = False)
+                expected_appended_result = DataIngestor(combined_csv_path).get_global_mean(question)
+
+                threadpool.append_rows(rows)
+                appended_stats = wait_ready(threadpool)
+                appended_result = json.loads(threadpool.execute("get_global_mean", [question]))
+
+                #  it waits for the refreshes, so that the table is saved before the restart
+                threadpool.shutdown()
+
+                restarted_threadpool = ThreadPool(DataIngestor(
+                    './nutrition_activity_obesity_usa_subset.csv', snapshot_dir = 'snapshot'))
+                restarted_stats = wait_ready(restarted_threadpool)
+                restarted_threadpool.shutdown()
+
+        self.assertGreater(stats["entries"], 0)
+        self.assertEqual(stats["computed_entries"], stats["entries"])
+        self.assertEqual(job_status, "completed")
+        self.assertEqual(job_result, expected_result)
+
+        self.assertEqual(appended_stats["entries"], stats["entries"])
+        self.assertLess(appended_stats["computed_entries"], stats["entries"])
+        self.assertAlmostEqual(appended_result["global_mean"],
+                               expected_appended_result["global_mean"])
+
+        #  only the question which received rows is computed again
+        self.assertEqual(restarted_stats["entries"], stats["entries"])
+        self.assertEqual(restarted_stats["loaded_entries"],
+                         stats["entries"] - appended_stats["computed_entries"])